@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+mock_engine.py
+
+A scripted uci engine for the benchmarks and tests of chess-chiller.py. It
+does not search, the scores and moves are derived from the zobrist hash of
+the position, so every run gives the same output for the same position.
+
+Usage:
+    python Engine/mock_engine.py --delay 0.002 --depth 12
+
+"""
+
+
+import argparse
+import random
+import sys
+import threading
+import time
+import chess
+import chess.polyglot
+
+
+class MockEngine:
+    """
+    Answers the uci commands on stdin, a search sends one info line per
+    multipv per depth and sleeps delay seconds after each depth, the scores
+    of a depth differ from the final ones by up to noise cp, less at higher
+    depths
+    """
+    def __init__(self, delay=0.002, depth=12, minscore=-400, maxscore=800,
+                 gap=300, switch=5, seed=0, noise=0, out=sys.stdout):
+        self.delay = delay
+        self.depth = depth
+        self.minscore = minscore
+        self.maxscore = maxscore
+        self.gap = gap
+        self.switch = switch
+        self.seed = seed
+        self.noise = noise
+        self.out = out
+        self.multipv = 1
+        self.board = chess.Board()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def send(self, line):
+        self.out.write(line + '\n')
+        self.out.flush()
+
+    def scores(self, board):
+        """ Returns the moves and scores of the multipv lines of board """
+        rng = random.Random(chess.polyglot.zobrist_hash(board) ^ self.seed)
+        moves = sorted(board.legal_moves, key=lambda m: m.uci())
+        rng.shuffle(moves)
+        best = rng.randint(self.minscore, self.maxscore)
+        return moves, [best - k*rng.randint(0, self.gap) for k in range(len(moves))]
+
+    def search(self, board, depth, movetime, nodes):
+        """ Send the info lines and the bestmove of board """
+        t0 = time.perf_counter()
+        moves, scores = self.scores(board)
+        rng = random.Random(chess.polyglot.zobrist_hash(board) ^ self.seed ^ 1)
+        bestmove = None
+        for d in range(1, depth + 1):
+            if self.stop_event.is_set():
+                break
+            elapsed = int(1000*(time.perf_counter() - t0))
+            if movetime is not None and elapsed >= movetime:
+                break
+            if nodes is not None and (d - 1)*1000 >= nodes:
+                break
+
+            # The best move changes every switch depths
+            shift = d // self.switch if self.switch else 0
+            for k in range(min(self.multipv, len(moves))):
+                move = moves[(k + shift) % len(moves)]
+                score = scores[k]
+                if self.noise:
+                    score += rng.randint(-self.noise, self.noise)*(self.depth - d)//self.depth
+                self.send('info depth {} seldepth {} multipv {} score cp {} nodes {} nps {} time {} pv {}'.format(
+                        d, d, k + 1, score, d*1000,
+                        int(d*1000000/max(elapsed, 1)), elapsed, move.uci()))
+                if k == 0:
+                    bestmove = move
+            time.sleep(self.delay)
+        self.send('bestmove {}'.format(bestmove.uci() if bestmove else '0000'))
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def position(self, tokens):
+        if tokens[0] == 'startpos':
+            self.board = chess.Board()
+            rest = tokens[1:]
+        else:
+            i = tokens.index('moves') if 'moves' in tokens else len(tokens)
+            self.board = chess.Board(' '.join(tokens[1:i]))
+            rest = tokens[i:]
+        for move in rest[1:]:
+            self.board.push_uci(move)
+
+    def go(self, tokens):
+        def value(name):
+            return int(tokens[tokens.index(name) + 1]) if name in tokens else None
+        depth = min(value('depth') or self.depth, self.depth)
+        self.stop()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.search,
+                                       args=(self.board.copy(), depth,
+                                             value('movetime'), value('nodes')))
+        self.thread.start()
+
+    def run(self, lines):
+        for line in lines:
+            tokens = line.split()
+            if not tokens:
+                continue
+            command = tokens[0]
+            if command == 'uci':
+                self.send('id name MockEngine')
+                self.send('id author chess-chiller')
+                self.send('option name Hash type spin default 16 min 1 max 4096')
+                self.send('option name Threads type spin default 1 min 1 max 64')
+                self.send('option name MultiPV type spin default 1 min 1 max 10')
+                self.send('uciok')
+            elif command == 'isready':
+                self.send('readyok')
+            elif command == 'setoption':
+                if 'MultiPV' in tokens:
+                    self.multipv = int(tokens[-1])
+            elif command == 'ucinewgame':
+                self.board = chess.Board()
+            elif command == 'position':
+                self.position(tokens[1:])
+            elif command == 'go':
+                self.go(tokens[1:])
+            elif command == 'stop':
+                self.stop()
+            elif command == 'quit':
+                break
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A scripted uci engine for benchmarks')
+    parser.add_argument('--delay', help='sleep in sec after each depth (default=0.002)',
+                        default=0.002, type=float)
+    parser.add_argument('--depth', help='maximum depth of a search (default=12)',
+                        default=12, type=int)
+    parser.add_argument('--minscore', help='minimum best score in cp (default=-400)',
+                        default=-400, type=int)
+    parser.add_argument('--maxscore', help='maximum best score in cp (default=800)',
+                        default=800, type=int)
+    parser.add_argument('--gap', help='maximum score gap in cp between multipv lines (default=300)',
+                        default=300, type=int)
+    parser.add_argument('--switch', help='the best move changes every n depths, 0 never (default=5)',
+                        default=5, type=int)
+    parser.add_argument('--seed', help='seed of the scores (default=0)',
+                        default=0, type=int)
+    parser.add_argument('--noise', help='maximum difference in cp of the scores of a depth from the final scores (default=0)',
+                        default=0, type=int)
+    args = parser.parse_args()
+
+    MockEngine(delay=args.delay, depth=args.depth, minscore=args.minscore,
+               maxscore=args.maxscore, gap=args.gap, switch=args.switch,
+               seed=args.seed, noise=args.noise).run(sys.stdin)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+
+Benchmarks of chess-chiller.py
+
+Usage:
+    python benchmark.py prefilter --inpgn PGN/WorldBlitz2018.pgn
+    python benchmark.py run --output bench.json --baseline bench_v0.3.json
+
+"""
+
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import chess
+import chess.pgn
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_chiller():
+    """ Import chess-chiller.py as a module """
+    fn = os.path.join(HERE, 'chess-chiller.py')
+    spec = importlib.util.spec_from_file_location('chess_chiller', fn)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_boards(pgnfns, maxboards):
+    """ Returns a list of all positions in the games of the pgn files """
+    boards = []
+    for pgnfn in pgnfns:
+        with open(pgnfn, 'r') as pgn:
+            game = chess.pgn.read_game(pgn)
+            while game and len(boards) < maxboards:
+                board = game.board()
+                for move in game.mainline_moves():
+                    board.push(move)
+                    boards.append(board.copy(stack=False))
+                game = chess.pgn.read_game(pgn)
+    return boards[:maxboards]
+
+
+def legacy_piece_value(board):
+    """ piece_value() of chess-chiller v0.3 """
+    board_pieces = board.epd().split()[0]
+    bn = board_pieces.count('n') * 3
+    bb = board_pieces.count('b') * 3
+    br = board_pieces.count('r') * 5
+    bq = board_pieces.count('q') * 9
+    wn = board_pieces.count('N') * 3
+    wb = board_pieces.count('B') * 3
+    wr = board_pieces.count('R') * 5
+    wq = board_pieces.count('Q') * 9
+
+    pcvalue = bn + bb + br + bq + wn + wb + wr + wq
+
+    logging.info('piece value: {}'.format(pcvalue))
+
+    return pcvalue
+
+
+def legacy_abs_pinned(board, color):
+    """ abs_pinned() of chess-chiller v0.3 """
+    for sq in chess.SQUARES:
+        if board.is_pinned(color, sq) \
+            and board.piece_at(sq) != chess.Piece(chess.PAWN, color):
+            logging.info('piece at square {} ({}) is pinned'.format(sq, board.piece_at(sq)))
+            logging.debug('\n{}'.format(board))
+            squares = chess.SquareSet([sq])
+            logging.debug('\n{}'.format(squares))
+            return True
+
+    return False
+
+
+def legacy_prefilter(board, minpiecevalue, maxpiecevalue, pin):
+    """ The static filters of analyze_game() of chess-chiller v0.3 """
+    pcval = legacy_piece_value(board)
+    if pcval < minpiecevalue:
+        return 'minpiecevalue', pcval
+    if pcval > maxpiecevalue:
+        return 'maxpiecevalue', pcval
+    if pin and not legacy_abs_pinned(board, board.turn ^ 1):
+        return 'pin', pcval
+    if board.is_check():
+        return 'check', pcval
+    return None, pcval
+
+
+def timeit(func, repeat):
+    """ Returns the best time of repeat calls of func """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+def bench_prefilter(args):
+    """ Compare the bitboard prefilters with the string and per-square scans of v0.3 """
+    chiller = load_chiller()
+    boards = read_boards(args.inpgn, args.positions)
+    print('positions: {}'.format(len(boards)))
+
+    # The results should be the same on every position
+    mismatch = 0
+    for board in boards:
+        if chiller.piece_value(board) != legacy_piece_value(board):
+            mismatch += 1
+        for color in chess.COLORS:
+            if chiller.abs_pinned(board, color) != legacy_abs_pinned(board, color):
+                mismatch += 1
+    for pin in [False, True]:
+        new = chiller.prefilter_batch(boards, args.minpiecevalue, args.maxpiecevalue, pin)
+        old = [legacy_prefilter(board, args.minpiecevalue, args.maxpiecevalue, pin)
+               for board in boards]
+        mismatch += sum(a != b for a, b in zip(new, old))
+    print('mismatches: {}'.format(mismatch))
+
+    rows = [
+        ('piece_value',
+         lambda: [legacy_piece_value(b) for b in boards],
+         lambda: [chiller.piece_value(b) for b in boards]),
+        ('abs_pinned',
+         lambda: [legacy_abs_pinned(b, not b.turn) for b in boards],
+         lambda: [chiller.abs_pinned(b, not b.turn) for b in boards]),
+        ('prefilter --pin',
+         lambda: [legacy_prefilter(b, args.minpiecevalue, args.maxpiecevalue, True) for b in boards],
+         lambda: chiller.prefilter_batch(boards, args.minpiecevalue, args.maxpiecevalue, True)),
+    ]
+    print('{:<16} {:>12} {:>12} {:>8}'.format('function', 'v0.3 us/pos', 'new us/pos', 'speedup'))
+    for name, old, new in rows:
+        told = timeit(old, args.repeat)
+        tnew = timeit(new, args.repeat)
+        print('{:<16} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+                name, 1e6*told/len(boards), 1e6*tnew/len(boards), told/tnew))
+
+    return mismatch == 0
+
+
+def mock_engine_command(args):
+    """ Returns the command line of Engine/mock_engine.py """
+    return [sys.executable, os.path.join(HERE, 'Engine', 'mock_engine.py'),
+            '--delay', str(args.engine_delay), '--depth', str(args.engine_depth),
+            '--gap', str(args.engine_gap), '--seed', str(args.seed),
+            '--noise', str(args.engine_noise)]
+
+
+class StageTimer:
+    """ Replaces functions of a module by wrappers that add up their time per stage """
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+
+    def wrap(self, obj, name, stage):
+        func = getattr(obj, name)
+        self.times.setdefault(stage, 0.0)
+        self.calls.setdefault(stage, 0)
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.times[stage] += time.perf_counter() - t0
+                self.calls[stage] += 1
+
+        setattr(obj, name, timed)
+
+
+def peak_rss_mb():
+    """ Returns the peak resident memory of the process in MB or None """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return rss/1e6 if sys.platform == 'darwin' else rss/1e3
+
+
+def run_chiller(args, chiller, outdir, extra_options=None):
+    """ 
+    Analyze the games of args.inpgn with the mock engine, returns the
+    measurements, extra_options are passed to analyze_game()
+    """
+    timer = StageTimer()
+    timer.wrap(chiller, 'prefilter', 'prefilter')
+    timer.wrap(chiller, 'classify_position', 'classify')
+    timer.wrap(chiller, 'start_search', 'search')
+    timer.wrap(chiller, 'wait_search', 'engine')
+    timer.wrap(chiller, 'start_engine', 'engine_start')
+    timer.wrap(chiller, 'stop_engine', 'engine_start')
+    timer.wrap(chiller.OutputWriter, 'write', 'output')
+    timer.wrap(chiller.OutputWriter, 'flush', 'output')
+    timer.wrap(chiller.OutputWriter, 'close', 'output')
+
+    # The same thresholds as the defaults of chess-chiller.py, mintime 0
+    # makes the early exits depend only on the scores of the mock engine
+    options = dict(mintime=0.0, maxtime=args.maxtime, minscorediffcheck=200,
+                   minbs1th1=2000, minbs1th2=1000, minbs1th3=500,
+                   maxbs2th1=300, maxbs2th2=200, maxbs2th3=100,
+                   weightsfile=None, skipdraw=False, pin=False,
+                   positional=False, minpiecevalue=0, maxpiecevalue=62,
+                   disable_complexity=False, save_last_move=False)
+    options.update(extra_options or {})
+    metrics = chiller.Metrics()
+    options['metrics'] = metrics
+
+    outepdfn = os.path.join(outdir, 'interesting.epd')
+    dullfn = os.path.join(outdir, 'dull.epd')
+    outpgnfn = os.path.join(outdir, 'interesting.pgn')
+    writer = chiller.OutputWriter({outepdfn: 'interesting', dullfn: 'dull', outpgnfn: 'pgn'})
+    first, last = chiller.parse_game_range(args.games)
+    pgn_time, games = 0.0, 0
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    for pgnfn in args.inpgn:
+        with open(pgnfn, 'r') as pgn:
+            reader = chiller.GameReader(pgn, chiller.GameFilter(), first=first, last=last)
+            chiller.analyze_games(reader, mock_engine_command(args), 64, 1, None,
+                                  args.analysis_start_move, outepdfn, dullfn,
+                                  outpgnfn, options, writer)
+            pgn_time += reader.skim_time + reader.parse_time
+            games += reader.parsed
+    writer.close()
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+    peak_python = None
+    if args.tracemalloc:
+        peak_python = tracemalloc.get_traced_memory()[1]/1e6
+        tracemalloc.stop()
+
+    records = {}
+    for kind, fn in [('interesting', outepdfn), ('dull', dullfn)]:
+        records[kind] = 0
+        if os.path.isfile(fn):
+            with open(fn, 'r') as f:
+                records[kind] = sum(1 for _ in f)
+
+    positions = max(metrics.snapshot()['counters'].get('positions', 0), 1)
+    engine = timer.times['engine'] + timer.times['engine_start']
+    return {
+        'games': games,
+        'positions': positions,
+        'searches': timer.calls['search'],
+        'interesting': records['interesting'],
+        'dull': records['dull'],
+        'wall_sec': wall,
+        'cpu_sec': cpu,
+        'positions_per_sec': positions/wall,
+        'overhead_per_position_ms': 1000*(wall - engine)/positions,
+        'filters_sec': timer.times['prefilter'] + timer.times['classify'],
+        'pgn_sec': pgn_time,
+        'output_sec': timer.times['output'],
+        'engine_wait_sec': timer.times['engine'],
+        'engine_start_sec': timer.times['engine_start'],
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_python_mb': peak_python,
+    }
+
+
+# Metrics of the baseline comparison, True if a higher value is better
+COMPARED = [('positions_per_sec', True), ('overhead_per_position_ms', False),
+            ('filters_sec', False), ('pgn_sec', False), ('output_sec', False),
+            ('peak_rss_mb', False)]
+
+
+def compare_baseline(result, baseline, tolerance):
+    """ Print the change of each metric, returns False on a regression """
+    ok = True
+    for key in ['games', 'positions', 'searches', 'interesting', 'dull']:
+        if result[key] != baseline[key]:
+            print('{} changed from {} to {}, the output is not the same'.format(
+                    key, baseline[key], result[key]))
+            ok = False
+    print('{:<26} {:>12} {:>12} {:>8}'.format('metric', 'baseline', 'current', 'change'))
+    for key, higher_is_better in COMPARED:
+        old, new = baseline.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = new/old - 1
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            flag = ' regression'
+            ok = False
+        print('{:<26} {:>12.3f} {:>12.3f} {:>+7.1%}{}'.format(key, old, new, change, flag))
+    return ok
+
+
+def run_chiller_logged(args, chiller, level, queued, extra_options=None):
+    """ 
+    run_chiller() with the logs of chess-chiller.py --log level, the log
+    files are written to a temporary directory and the console logs and
+    progress lines are not shown
+    """
+    root = logging.getLogger()
+    cwd = os.getcwd()
+    args = argparse.Namespace(**vars(args))
+    args.inpgn = [os.path.abspath(fn) for fn in args.inpgn]
+    with tempfile.TemporaryDirectory() as outdir, \
+            open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        os.chdir(outdir)
+        listener = chiller.initialize_logger(getattr(logging, level.upper()), queued=queued)
+        handlers = root.handlers[:] + list(listener.handlers if listener else [])
+        try:
+            result = run_chiller(args, chiller, outdir, extra_options)
+
+            # Time to write the logs that are still in the queue
+            t0 = time.perf_counter()
+            if listener is not None:
+                listener.stop()
+            result['log_drain_sec'] = time.perf_counter() - t0
+        finally:
+            for handler in handlers:
+                root.removeHandler(handler)
+                handler.close()
+            os.chdir(cwd)
+    return result
+
+
+def bench_run(args):
+    """ Measure the overhead of chess-chiller.py per position with the mock engine """
+    chiller = load_chiller()
+    result = run_chiller_logged(args, chiller, args.log, not args.log_sync)
+
+    report = {
+        'version': chiller.__version__,
+        'python': platform.python_version(),
+        'chess': chess.__version__,
+        'platform': platform.platform(),
+        'settings': {'inpgn': args.inpgn, 'games': args.games,
+                     'maxtime': args.maxtime,
+                     'analysis_start_move': args.analysis_start_move,
+                     'engine': mock_engine_command(args)[1:],
+                     'log': args.log, 'log_sync': args.log_sync,
+                     'tracemalloc': args.tracemalloc},
+        'result': result,
+    }
+
+    for key, value in result.items():
+        if isinstance(value, float):
+            print('{:<26} {:>12.3f}'.format(key, value))
+        else:
+            print('{:<26} {:>12}'.format(key, str(value)))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('saved to {}'.format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        return compare_baseline(result, baseline['result'], args.tolerance)
+    return True
+
+
+def add_run_arguments(p):
+    """ Add the options of the runs with the mock engine to the subparser p """
+    p.add_argument('-i', '--inpgn', help='input pgn files (default=all pgn files in PGN/)',
+                   nargs='+', default=[os.path.join(HERE, 'PGN', fn) for fn in
+                                       sorted(os.listdir(os.path.join(HERE, 'PGN')))])
+    p.add_argument('--games', help='range of games of each pgn file (default=1-5)',
+                   default='1-5')
+    p.add_argument('--maxtime', help='maximum search time in sec (default=1.0)',
+                   default=1.0, type=float)
+    p.add_argument('--analysis-start-move', default=16, type=int)
+    p.add_argument('--engine-delay', help='sleep in sec of the mock engine per depth (default=0.001)',
+                   default=0.001, type=float)
+    p.add_argument('--engine-depth', help='maximum depth of the mock engine (default=12)',
+                   default=12, type=int)
+    p.add_argument('--engine-gap', help='maximum score gap in cp of the mock engine (default=600)',
+                   default=600, type=int)
+    p.add_argument('--seed', help='seed of the mock engine scores (default=0)',
+                   default=0, type=int)
+    p.add_argument('--engine-noise', help='maximum score change in cp of the mock engine between depths (default=0)',
+                   default=0, type=int)
+
+
+def bench_logging(args):
+    """ Compare the overhead per position of the log levels, synchronous and queued """
+    modes = [('critical', True)]
+    for level in args.levels:
+        modes += [(level, False), (level, True)]
+
+    rows = []
+    for level, queued in modes:
+        # A fresh module, run_chiller() wraps its functions
+        result = run_chiller_logged(args, load_chiller(), level, queued)
+        rows.append({'log': level, 'queued': queued, 'result': result})
+
+    base = rows[0]['result']['overhead_per_position_ms']
+    print('{:<10} {:<7} {:>10} {:>14} {:>10} {:>10}'.format(
+            'log', 'queued', 'wall sec', 'overhead ms', 'vs crit', 'drain sec'))
+    for row in rows:
+        result = row['result']
+        print('{:<10} {:<7} {:>10.2f} {:>14.3f} {:>9.2f}x {:>10.3f}'.format(
+                row['log'], str(row['queued']), result['wall_sec'],
+                result['overhead_per_position_ms'],
+                result['overhead_per_position_ms']/base if base else 0.0,
+                result['log_drain_sec']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': load_chiller().__version__, 'rows': rows}, f, indent=2)
+        print('saved to {}'.format(args.output))
+    return True
+
+
+def bench_session(args):
+    """ Compare the throughput of the engine session modes at the same maxtime """
+    modes = [('default', {}),
+             ('session', {'session': True}),
+             ('session+prefetch', {'session': True, 'prefetch': True})]
+    rows = []
+    for name, extra_options in modes:
+        # The fastest of repeat runs, the mock engine timing is noisy
+        results = [run_chiller_logged(args, load_chiller(), args.log, True, extra_options)
+                   for _ in range(args.repeat)]
+        result = min(results, key=lambda r: r['wall_sec'])
+        rows.append({'mode': name, 'options': extra_options, 'result': result})
+
+    base = rows[0]['result']['positions_per_sec']
+    print('{:<18} {:>10} {:>10} {:>14} {:>14} {:>8}'.format(
+            'mode', 'wall sec', 'pos/sec', 'overhead ms', 'engine wait', 'speedup'))
+    for row in rows:
+        result = row['result']
+        print('{:<18} {:>10.2f} {:>10.1f} {:>14.3f} {:>14.2f} {:>7.2f}x'.format(
+                row['mode'], result['wall_sec'], result['positions_per_sec'],
+                result['overhead_per_position_ms'], result['engine_wait_sec'],
+                result['positions_per_sec']/base if base else 0.0))
+
+    # The modes must not change the output
+    ok = True
+    for row in rows[1:]:
+        for key in ['positions', 'searches', 'interesting', 'dull']:
+            if row['result'][key] != rows[0]['result'][key]:
+                print('{} of {} is {}, the default is {}'.format(
+                        key, row['mode'], row['result'][key], rows[0]['result'][key]))
+                ok = False
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': load_chiller().__version__, 'rows': rows}, f, indent=2)
+        print('saved to {}'.format(args.output))
+    return ok
+
+
+def bench_stop(args):
+    """ Compare the search time and the verdicts of the early stop policies with full searches """
+    chiller = load_chiller()
+    policies = [('full', None, {'mintime': float('inf')}),
+                ('default', None, {})]
+    for name in args.policies:
+        policy = chiller.stop_policy(name, 500, 100, depths=args.stop_depths,
+                                     margin=args.stop_margin, depth=args.stop_depth)
+        policies.append((name, policy, {}))
+
+    rows = []
+    verdicts = {}
+    for name, policy, extra_options in policies:
+        # A fresh module, run_chiller() wraps its functions, the verdict of
+        # every searched position is recorded
+        chiller = load_chiller()
+        found = verdicts[name] = {}
+        classify = chiller.classify_position
+
+        def recorded(board, *a, found=found, classify=classify, **kw):
+            verdict = classify(board, *a, **kw)
+            found[board.epd()] = verdict
+            return verdict
+
+        chiller.classify_position = recorded
+        result = run_chiller_logged(args, chiller, args.log, True,
+                                    dict(extra_options, stop_policy=policy))
+        rows.append({'policy': name, 'result': result})
+
+    full = verdicts['full']
+    interesting = [epd for epd, verdict in full.items() if verdict == 'interesting']
+    print('{:<10} {:>10} {:>12} {:>10} {:>12} {:>10}'.format(
+            'policy', 'searches', 'sec/search', 'speedup', 'agreement', 'recall'))
+    base = None
+    for row in rows:
+        result = row['result']
+        found = verdicts[row['policy']]
+        sec = result['engine_wait_sec']/max(result['searches'], 1)
+        base = base or sec
+        row['sec_per_search'] = sec
+        row['agreement'] = sum(found.get(epd) == verdict for epd, verdict in full.items())/max(len(full), 1)
+        row['recall'] = sum(found.get(epd) == 'interesting' for epd in interesting)/max(len(interesting), 1)
+        print('{:<10} {:>10} {:>12.4f} {:>9.2f}x {:>11.1%} {:>9.1%}'.format(
+                row['policy'], result['searches'], sec, base/sec if sec else 0.0,
+                row['agreement'], row['recall']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': chiller.__version__, 'rows': rows}, f, indent=2)
+        print('saved to {}'.format(args.output))
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of chess-chiller.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('prefilter', help='compare the static prefilters with those of v0.3')
+    p.add_argument('-i', '--inpgn', help='input pgn files (default=PGN/tatagpa19.pgn)',
+                   nargs='+', default=['PGN/tatagpa19.pgn'])
+    p.add_argument('--positions', help='maximum number of positions (default=20000)',
+                   default=20000, type=int)
+    p.add_argument('--minpiecevalue', default=0, type=int)
+    p.add_argument('--maxpiecevalue', default=62, type=int)
+    p.add_argument('--repeat', help='number of timing runs, the best is reported (default=3)',
+                   default=3, type=int)
+    p.set_defaults(func=bench_prefilter)
+
+    p = subparsers.add_parser('run', help='analyze games with the mock engine and measure the overhead')
+    add_run_arguments(p)
+    p.add_argument('--log', help='log level of chess-chiller.py (default=critical)',
+                   choices=['debug', 'info', 'warning', 'error', 'critical'],
+                   default='critical')
+    p.add_argument('--log-sync', help='write the logs in the logging thread, not in a background thread',
+                   action='store_true')
+    p.add_argument('--tracemalloc', help='measure the peak python memory, slows the run',
+                   action='store_true')
+    p.add_argument('-o', '--output', help='save the results to this json file')
+    p.add_argument('--baseline', help='json file of an earlier run to compare with')
+    p.add_argument('--tolerance', help='allowed slowdown against the baseline (default=0.2)',
+                   default=0.2, type=float)
+    p.set_defaults(func=bench_run)
+
+    p = subparsers.add_parser('logging', help='compare the overhead of the log levels with --log critical')
+    add_run_arguments(p)
+    p.add_argument('--levels', help='log levels to compare (default=info debug)',
+                   nargs='+', default=['info', 'debug'],
+                   choices=['debug', 'info', 'warning', 'error'])
+    p.add_argument('-o', '--output', help='save the results to this json file')
+    p.set_defaults(func=bench_logging, tracemalloc=False)
+
+    p = subparsers.add_parser('session', help='compare the engine session and prefetch modes')
+    add_run_arguments(p)
+    p.add_argument('--log', help='log level of chess-chiller.py (default=critical)',
+                   choices=['debug', 'info', 'warning', 'error', 'critical'],
+                   default='critical')
+    p.add_argument('-o', '--output', help='save the results to this json file')
+    p.add_argument('--repeat', help='number of runs of each mode, the fastest is reported (default=3)',
+                   default=3, type=int)
+    p.set_defaults(func=bench_session, tracemalloc=False)
+
+    p = subparsers.add_parser('stop', help='compare the early stop policies with full searches')
+    add_run_arguments(p)
+    p.add_argument('--policies', help='stop policies to compare (default=stable depth trend)',
+                   nargs='+', default=['stable', 'depth', 'trend'],
+                   choices=['stable', 'depth', 'trend'])
+    p.add_argument('--stop-depths', type=int)
+    p.add_argument('--stop-margin', type=int)
+    p.add_argument('--stop-depth', type=int)
+    p.add_argument('--log', help='log level of chess-chiller.py (default=critical)',
+                   choices=['debug', 'info', 'warning', 'error', 'critical'],
+                   default='critical')
+    p.add_argument('-o', '--output', help='save the results to this json file')
+    p.set_defaults(func=bench_stop, tracemalloc=False)
+
+    args = parser.parse_args()
+    if not args.func(args):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
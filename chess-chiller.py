@@ -7,33 +7,94 @@ Requirements:
     * python-chess v0.26.0 or up, https://github.com/niklasf/python-chess
     * Analysis engine that supports multipv and movetime commands
     * PGN file with games
+    * numpy, only for --columns and the reclassify command
     
 """
 
 
 import argparse
+import array
+import asyncio
+import atexit
+import bisect
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import copy
+import glob
+import gzip
+import heapq
+import http.server
+import io
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+import random
+import re
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
+import sys
+import threading
 import time
 import chess.pgn
 import chess.engine
+import chess.polyglot
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # .pgn.zst files can not be read
+    
+try:
+    import numpy as np
+except ImportError:
+    np = None  # --columns and reclassify are not available
 
 
 __version__ = 'v0.3'
 __author__ = 'fsmosca'
 
 
-def initialize_logger(logger_level):
-    """ Save logs to file, use RotatingFileHandler to avoid disk space overrun """
+class MessageQueueHandler(QueueHandler):
+    """
+    QueueHandler that only merges the args of a record into its message.
+
+    The default prepare() formats the whole record in the thread of the
+    logging call, here the formatters of the handlers of the QueueListener
+    do it in the listener thread. The args are still merged at once since
+    they can be changed by the caller before the listener gets the record.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def initialize_logger(logger_level, queued=True):
+    """ 
+    Save logs to file, use RotatingFileHandler to avoid disk space overrun
+    
+    If queued is true the handlers run in a background thread and a logging
+    call only puts the record in a queue. Returns the QueueListener of the
+    thread or None, its stop() writes the records still in the queue.
+    """
     logger = logging.getLogger()
     logger.setLevel(logger_level)
+    handlers = []
      
     # Creates console handler for info/warning/error/critical logs
     handler = logging.StreamHandler()
     handler.setLevel(logging.INFO)
     formatter = logging.Formatter("%(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers.append(handler)
  
     # Creates error/critical file handler
     handler = RotatingFileHandler("error.log", mode='w',
@@ -41,7 +102,7 @@ def initialize_logger(logger_level):
     handler.setLevel(logging.ERROR)
     formatter = logging.Formatter("%(asctime)s [%(threadName)-10.10s] [%(funcName)-12.12s] [%(levelname)-5.5s] > %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers.append(handler)
  
     # Creates debug/info/warning/error/critical file handler
     handler = RotatingFileHandler("all.log", mode='w',
@@ -49,360 +110,3657 @@ def initialize_logger(logger_level):
     handler.setLevel(logging.DEBUG)
     formatter = logging.Formatter("%(asctime)s [%(threadName)-10.10s] [%(funcName)-12.12s] [%(levelname)-5.5s] > %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers.append(handler)
+    
+    if not queued:
+        for handler in handlers:
+            logger.addHandler(handler)
+        return None
+    
+    # The records are formatted and written by the listener thread
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(MessageQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
     
     
-def save_as_pgn(outpgnfn, curboard, game, fen, bm, is_save_last_move=False):
+def append_to_file(fn, text):
+    """ Append text to file fn, this is the default output of analyze_game """
+    with open(fn, 'a') as f:
+        f.write(text)
+
+
+def save_as_pgn(outpgnfn, curboard, game, fen, bm, is_save_last_move=False,
+                emit=append_to_file):
     """ Save the epd in pgn format """
     move = None
-    mygame = chess.pgn.Game()
+    mygame = chess.pgn.Game(game.headers)
     mynode = mygame
 
     if is_save_last_move:
         move = curboard.pop()
         fen = curboard.fen()
 
-    with open(outpgnfn, 'a') as f:
-        for k, v in game.headers.items():
-            if k == 'Result':
-                mygame.headers[k] = '*'
-            else:
-                mygame.headers[k] = v
-        mygame.headers['FEN'] = fen
+    mygame.headers['Result'] = '*'
+    mygame.headers['FEN'] = fen
 
-        if is_save_last_move and move is not None:
-            mynode = mynode.add_main_variation(move)
+    if is_save_last_move and move is not None:
+        mynode = mynode.add_main_variation(move)
 
-        mynode = mynode.add_main_variation(bm)
+    mynode = mynode.add_main_variation(bm)
 
-        board = mynode.board()
-        if board.is_game_over():
-            if board.is_checkmate():
-                mygame.headers['Result'] = '1-0' if not board.turn else '0-1'
-            else:
-                mygame.headers['Result'] = '1/2-1/2'
+    board = mynode.board()
+    if board.is_game_over():
+        if board.is_checkmate():
+            mygame.headers['Result'] = '1-0' if not board.turn else '0-1'
+        else:
+            mygame.headers['Result'] = '1/2-1/2'
 
-        f.write('{}\n\n'.format(mygame))
+    emit(outpgnfn, '{}\n\n'.format(mygame))
 
 
 def piece_value(board):
     """ Returns piece value of the board except pawns and kings """
-    board_pieces = board.epd().split()[0]
-    bn = board_pieces.count('n') * 3
-    bb = board_pieces.count('b') * 3
-    br = board_pieces.count('r') * 5
-    bq = board_pieces.count('q') * 9
-    wn = board_pieces.count('N') * 3
-    wb = board_pieces.count('B') * 3
-    wr = board_pieces.count('R') * 5
-    wq = board_pieces.count('Q') * 9
+    return 3*chess.popcount(board.knights | board.bishops) \
+        + 5*chess.popcount(board.rooks) + 9*chess.popcount(board.queens)
+
+
+def interesting_pos(board, bs1, bs2, minbs1th1, minbs1th2, minbs1th3,
+                   maxbs2th1, maxbs2th2, maxbs2th3):
+    """ 
+    board: board position
+    bs1: bestscore1 from multipv 1
+    bs2: bestscore2 from multipv 2
+    
+    minbs1th1: minimum best score 1 threshold 1
+    minbs1th2: minimum best score 1 threshold 2
+    minbs1th3: minimum best score 1 threshold 3
+    
+    minbs1th1 > minbs1th2 > minbs1th3
+    
+    maxbs2th1: maximum best score 2 threshold 1
+    maxbs2th2: maximum best score 2 threshold 2
+    maxbs2th3: maximum best score 2 threshold 3
+    
+    maxbs2th1 > maxbs2th2 > maxbs2th3
+    
+    """
+    logging.info('bestscore1: %s, bestscore2: %s', bs1, bs2)
+    if bs1 >= minbs1th1:
+        # mate score
+        if bs1 >= 30000 and bs2 <= min(2000, 2*maxbs2th1):
+            return True
+        if bs2 <= maxbs2th1:
+            return True
+    elif bs1 >= minbs1th2:
+        if bs2 <= maxbs2th2:
+            return True
+    elif bs1 >= minbs1th3:
+        if bs2 <= maxbs2th3:
+            return True
+    
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('Not an interesting pos: %s', board.fen())
+    
+    return False
+
+
+def positional_pos(board, bs1, bs2, minbs1th1, minbs1th2, minbs1th3,
+                   maxbs2th1, maxbs2th2, maxbs2th3):
+    """ 
+    * The engine bestscore1 is not winning and bestscore2 is not lossing
+    * The score gap between bestscore1 and bestcore2 is  generally smaller    
+    """
+    if bs1 >= minbs1th1 and bs1 <= minbs1th1 + 50:
+        if bs2 <= maxbs2th1 and bs2 >= maxbs2th1 - 25:
+            return True
+    if bs1 >= minbs1th2 and bs1 <= minbs1th1:
+        if bs2 <= maxbs2th2 and bs2 >= maxbs2th2 - 25:
+            return True
+    if bs1 >= minbs1th3 and bs1 <= minbs1th2:
+        if bs2 <= maxbs2th3 and bs2 >= maxbs2th3 - 25:
+            return True
+    
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('Not positional: %s', board.fen())
+    
+    return False
+
+
+def classify_position(board, bs1, bs2, bm1, complexity, minbs1th1, minbs1th2,
+                      minbs1th3, maxbs2th1, maxbs2th2, maxbs2th3,
+                      positional=False, disable_complexity=False,
+                      metrics=None):
+    """ 
+    Classify a searched position with the score thresholds
+    
+    Returns interesting or dull, the file the position is saved to, or None
+    if the position is not saved at all. The reason of a None is counted in
+    metrics if it is not None.
+    """
+    # Don't save positions if score is already bad
+    if bs1 < minbs1th3:
+        logging.warning('Skip this pos, score %s is below minbs1th3 of %s', bs1, minbs1th3)
+        if metrics is not None:
+            metrics.count('skips', 'bs1')
+        return None
+    
+    # If complexity is 1 or less and if bestmove1 is a capture, skip this position
+    if board.is_capture(bm1) and not disable_complexity and complexity <= 1:
+        logging.warning('Skip this pos, bm1 is a capture and pos complexity is below 2')
+        if metrics is not None:
+            metrics.count('skips', 'capture')
+        return None
+    
+    if bs1 - bs2 < minbs1th3 - maxbs2th3:
+        logging.warning('Skip this pos, min score diff of %s is below user min score diff of %s',
+                        bs1 - bs2, minbs1th3 - maxbs2th3)
+        if metrics is not None:
+            metrics.count('skips', 'scorediff')
+        return None
+    
+    # Filter on --positional to skip positions
+    if positional:
+        # (1) Skip if bestmove1 is a capture or promote
+        if board.is_capture(bm1) or len(str(bm1)) == 5:
+            logging.warning('Skip this pos, the bestmove1 is a %s move', 'promote' if len(str(bm1))==5 else 'capture')
+            if metrics is not None:
+                metrics.count('skips', 'positional_move')
+            return None
+        
+    # Save epd if criteria is satisfied
+    if positional:
+        if positional_pos(board, bs1, bs2, minbs1th1, minbs1th2,
+                          minbs1th3, maxbs2th1, maxbs2th2, maxbs2th3):
+            return 'interesting'
+    else:
+        if interesting_pos(board, bs1, bs2, minbs1th1, minbs1th2,
+                           minbs1th3, maxbs2th1, maxbs2th2, maxbs2th3):
+            return 'interesting'
+        
+    return 'dull'
+
+
+def abs_pinned(board, color):
+    """ Returns true if one or more pieces of color color is pinned """
+    king = board.king(color)
+    if king is None:
+        return False
+    
+    rooks_and_queens = board.rooks | board.queens
+    bishops_and_queens = board.bishops | board.queens
+    snipers = ((chess.BB_RANK_ATTACKS[king][0] | chess.BB_FILE_ATTACKS[king][0]) & rooks_and_queens
+               | chess.BB_DIAG_ATTACKS[king][0] & bishops_and_queens) & board.occupied_co[not color]
+    pawns = board.pawns & board.occupied_co[color]
+    
+    # Same result as board.is_pinned() on every square not having a pawn
+    # of color. That is, the only piece between the king and a slider is
+    # pinned whatever its color, and if there is none the empty squares
+    # between them are pinned.
+    for sniper in chess.scan_reversed(snipers):
+        between = chess.between(king, sniper)
+        blockers = between & board.occupied
+        if not blockers:
+            if between:
+                return True
+        elif not blockers & (blockers - 1) and not blockers & pawns:
+            return True
+    
+    return False
+
+
+def prefilter(board, minpiecevalue=0, maxpiecevalue=62, pin=False, pcvalue=None):
+    """ 
+    Static filters that are applied before the engine is called
+    
+    Returns (reason, pcvalue), reason is None if the position can be
+    searched, otherwise minpiecevalue, maxpiecevalue, pin or check. pcvalue
+    is the piece value of the board if it is already known.
+    """
+    if pcvalue is None:
+        pcvalue = piece_value(board)
+    if pcvalue < minpiecevalue:
+        return 'minpiecevalue', pcvalue
+    if pcvalue > maxpiecevalue:
+        return 'maxpiecevalue', pcvalue
+    
+    # Skip this position if pin is set and no one of the not stm piece is pinned
+    if pin and not abs_pinned(board, not board.turn):
+        return 'pin', pcvalue
+    
+    # If side to move is in check, skip this position
+    if board.is_check():
+        return 'check', pcvalue
+    
+    return None, pcvalue
+
+
+def prefilter_batch(boards, minpiecevalue=0, maxpiecevalue=62, pin=False):
+    """ Returns a list of prefilter() results of boards """
+    return [prefilter(board, minpiecevalue, maxpiecevalue, pin) for board in boards]
+
+
+# The eval of a move comment, [%eval 0.35] or [%eval #-3] of lichess and
+# wv=0.35 of tcec and cutechess, in pawns from the white side, and the
+# search depth d=24 of tcec and cutechess
+PGN_EVAL_RE = re.compile(r'(?:\[%eval\s+|\bwv=)([-+#M0-9.]+)')
+PGN_DEPTH_RE = re.compile(r'\bd=(\d+)')
+
+
+def pgn_eval(comment, mindepth=0):
+    """ 
+    Returns the eval in cp from the white side of a move comment, mates
+    like the engine searches, or None if it has no eval or its d= depth is
+    below mindepth. Evals without a depth, like the ones of lichess, are
+    returned.
+    """
+    m = PGN_EVAL_RE.search(comment)
+    if m is None:
+        return None
+    if mindepth:
+        d = PGN_DEPTH_RE.search(comment)
+        if d is not None and int(d.group(1)) < mindepth:
+            return None
+    text = m.group(1)
+    mate = '#' in text or 'M' in text
+    text = text.replace('#', '').replace('M', '')
+    try:
+        value = float(text)
+    except ValueError:
+        return None
+    if mate:
+        moves = abs(int(value))
+        return 32000 - moves if not text.startswith('-') else -32000 + moves
+    return int(round(100*value))
+
+
+# Piece values of piece_value()
+PIECE_VALUES = {chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9}
+
+
+class GamePlan:
+    """ 
+    The positions of a game to search, found in one forward pass over its
+    moves before the engine is called
+    
+    Per position, the board before the game move of that ply, it records
+    the material, check and capture of the game move and if the move number
+    after the game move is at least start_move. The material is updated by
+    the captures and promotions of the moves.
+    
+    eligible has the plies, highest first, that the reverse loop of
+    analyze_game would search: from the end of the game back to the first
+    position with a move number below start_move after its game move, or
+    with more material than maxpiecevalue, without the positions that fail
+    the other prefilter tests, the ones from resume_ply on and the plies in
+    done.
+    
+    If evals is true the evals of the move comments are read too, evals[k]
+    is the eval after the move of ply first_ply + k or None, also if its
+    depth is below eval_depth.
+    """
+    
+    def __init__(self, game, start_move, minpiecevalue=0, maxpiecevalue=62,
+                 pin=False, resume_ply=None, evals=False, done=None, eval_depth=0):
+        board = game.board()
+        self.first_ply = board.ply()
+        self.moves = []
+        self.material = []
+        self.check = []
+        self.capture = []
+        self.in_window = []
+        self.reasons = []
+        self.evals = [] if evals else None
+        self.boards = {}
+        
+        material = piece_value(board)
+        for node in game.mainline():
+            move = node.move
+            if evals:
+                self.evals.append(pgn_eval(node.comment, eval_depth) if node.comment else None)
+            in_window = board.fullmove_number + (board.turn == chess.BLACK) >= start_move
+            reason = None
+            if in_window:
+                reason, _ = prefilter(board, minpiecevalue, maxpiecevalue, pin,
+                                      pcvalue=material)
+                if reason is None:
+                    self.boards[board.ply()] = board.copy(stack=1)
+            capture = board.is_capture(move)
+            self.moves.append(move)
+            self.material.append(material)
+            self.check.append(board.is_check())
+            self.capture.append(capture)
+            self.in_window.append(in_window)
+            self.reasons.append(reason)
+            
+            if capture and not board.is_en_passant(move):
+                material -= PIECE_VALUES.get(board.piece_type_at(move.to_square), 0)
+            if move.promotion is not None:
+                material += PIECE_VALUES.get(move.promotion, 0)
+            board.push(move)
+            
+        # The positions the reverse loop visits, it stops at the first
+        # position out of the window or above maxpiecevalue
+        self.visited = 0
+        self.skipped = []
+        self.eligible = []
+        self.cut = None
+        for k in reversed(range(len(self.moves))):
+            ply = self.first_ply + k
+            if resume_ply is not None and ply + 1 > resume_ply:
+                continue
+            if done and ply in done:
+                continue
+            if not self.in_window[k]:
+                self.cut = 'start_move'
+                break
+            self.visited += 1
+            reason = self.reasons[k]
+            if reason is not None:
+                self.skipped.append((ply, reason, self.material[k]))
+                if reason == 'maxpiecevalue':
+                    self.cut = reason
+                    break
+                continue
+            self.eligible.append(ply)
+        self.boards = {ply: self.boards[ply] for ply in self.eligible}
+        
+    def move_at(self, ply):
+        """ Returns the game move of the position at ply """
+        return self.moves[ply - self.first_ply]
+    
+    def material_at(self, ply):
+        return self.material[ply - self.first_ply]
+    
+    def evals_at(self, ply):
+        """ 
+        Returns the evals before and after the game move of the position at
+        ply, from the white side, None if not known
+        """
+        k = ply - self.first_ply
+        if not self.evals:
+            return None, None
+        return self.evals[k - 1] if k > 0 else None, self.evals[k]
+    
+    def swing_at(self, ply):
+        """ Returns the change in cp of the eval by the game move at ply, or None if not known """
+        before, after = self.evals_at(ply)
+        if before is None or after is None:
+            return None
+        return abs(after - before)
+    
+    def skip_counts(self):
+        """ Returns {prefilter reason: number of visited positions skipped by it} """
+        counts = {}
+        for _, reason, _ in self.skipped:
+            counts[reason] = counts.get(reason, 0) + 1
+        return counts
+    
+    def by_priority(self):
+        """ 
+        Returns the eligible plies, first the positions where the game move is
+        a capture, then the ones with more material, then the later ones. If
+        the evals were read the positions with the largest eval change by the
+        game move come first.
+        """
+        if self.evals is not None:
+            return sorted(self.eligible, key=lambda ply: (-(self.swing_at(ply) or 0),
+                                                          not self.capture[ply - self.first_ply],
+                                                          -self.material_at(ply), -ply))
+        return sorted(self.eligible, key=lambda ply: (not self.capture[ply - self.first_ply],
+                                                      -self.material_at(ply), -ply))
+
+
+_engine_loop = None
+_engine_loop_lock = threading.Lock()
+
+
+def engine_loop():
+    """ 
+    Returns the event loop that drives all engines of the run, it is
+    started in a background thread on the first call
+    """
+    global _engine_loop
+    with _engine_loop_lock:
+        if _engine_loop is None:
+            _engine_loop = asyncio.new_event_loop()
+            threading.Thread(target=_engine_loop.run_forever, name='engineloop',
+                             daemon=True).start()
+    return _engine_loop
+
+
+def run_on_engine_loop(coro):
+    """ Run the coroutine coro on the engine event loop and return its result """
+    return asyncio.run_coroutine_threadsafe(coro, engine_loop()).result()
+
+
+class StopPolicy:
+    """ 
+    Early stop policy of the multipv 2 searches, this one never stops them
+    
+    check() is called when both lines of a depth are known with the history
+    of the search, a list of (depth, bs1, bs2, bestmovechanges, time) per
+    depth, and returns the reason to stop the search or None. The fixed bs1
+    and scorediff exits after mintime are applied with every policy.
+    """
+    
+    name = 'default'
+    
+    def check(self, history):
+        return None
+    
+    def key(self):
+        """ Returns the name and the parameters of the policy as text """
+        return '{}({})'.format(self.name, ','.join('{}={}'.format(k, v)
+                                                   for k, v in sorted(vars(self).items())))
+    
+    
+class StabilityPolicy(StopPolicy):
+    """ Stop when the best move did not change and the scores stayed within margin cp over the last depths """
+    
+    name = 'stable'
+    
+    def __init__(self, depths=4, margin=10, mindepth=6):
+        self.depths = depths
+        self.margin = margin
+        self.mindepth = mindepth
+        
+    def check(self, history):
+        if len(history) < self.depths or history[-1][0] < self.mindepth:
+            return None
+        last = history[-self.depths:]
+        if last[0][3] != last[-1][3]:
+            return None
+        for i in (1, 2):
+            scores = [h[i] for h in last]
+            if max(scores) - min(scores) > self.margin:
+                return None
+        return 'stable'
+    
+    
+class DepthPolicy(StopPolicy):
+    """ Stop when the search has reached depth """
+    
+    name = 'depth'
+    
+    def __init__(self, depth=20):
+        self.depth = depth
+        
+    def check(self, history):
+        return 'depth' if history[-1][0] >= self.depth else None
+    
+    
+class TrendPolicy(StopPolicy):
+    """ 
+    Stop when the position can no longer be saved
+    
+    A line is fitted to bs1 and to bs1 - bs2 of the last depths. If at ahead
+    more depths bs1 is predicted below minbs1th3 or the score gap below
+    minbs1th3 - maxbs2th3, both by more than margin cp, the search is stopped.
+    """
+    
+    name = 'trend'
+    
+    def __init__(self, minbs1th3, maxbs2th3, depths=4, margin=50, ahead=2,
+                 mindepth=6):
+        self.minbs1th3 = minbs1th3
+        self.maxbs2th3 = maxbs2th3
+        self.depths = depths
+        self.margin = margin
+        self.ahead = ahead
+        self.mindepth = mindepth
+        
+    @staticmethod
+    def predict(points, x):
+        """ Returns the value at x of the least squares line of the (x, y) points """
+        n = len(points)
+        mx = sum(p[0] for p in points)/n
+        my = sum(p[1] for p in points)/n
+        sxx = sum((p[0] - mx)**2 for p in points)
+        if sxx == 0:
+            return my
+        slope = sum((p[0] - mx)*(p[1] - my) for p in points)/sxx
+        return my + slope*(x - mx)
+        
+    def check(self, history):
+        if len(history) < self.depths or history[-1][0] < self.mindepth:
+            return None
+        last = history[-self.depths:]
+        x = last[-1][0] + self.ahead
+        bs1 = self.predict([(h[0], h[1]) for h in last], x)
+        gap = self.predict([(h[0], h[1] - h[2]) for h in last], x)
+        if bs1 + self.margin < self.minbs1th3 \
+                or gap + self.margin < self.minbs1th3 - self.maxbs2th3:
+            return 'trend'
+        return None
+    
+    
+STOP_POLICIES = ('default', 'stable', 'depth', 'trend')
+
+
+def stop_policy(name, minbs1th3, maxbs2th3, depths=None, margin=None, depth=None):
+    """ Returns the StopPolicy of name, depths, margin and depth are the defaults of the policy if None """
+    options = {k: v for k, v in (('depths', depths), ('margin', margin)) if v is not None}
+    if name == 'stable':
+        return StabilityPolicy(**options)
+    if name == 'depth':
+        return DepthPolicy(depth) if depth is not None else DepthPolicy()
+    if name == 'trend':
+        return TrendPolicy(minbs1th3, maxbs2th3, **options)
+    return StopPolicy()
+
+
+def search_position(engine, board, limit, mintime, minbs1th3, minscorediffcheck,
+                    game=None, policy=None):
+    """ 
+    Run the engine at multipv 2 and return a dict with the search result
+    
+    The dict has bm1, bs1, bm2, bs2, depth, pv, complexity, time, early and
+    exit, early is true if the search was stopped before the limit was
+    reached and exit is its reason, bs1, scorediff or the reason of the
+    StopPolicy policy.
+    The search runs on the engine event loop, the calling thread waits for
+    it. The engine gets ucinewgame only when game is not the game of its
+    previous search.
+    """
+    return wait_search(start_search(engine, board, limit, mintime, minbs1th3,
+                                    minscorediffcheck, game, policy))
+
+
+def start_search(engine, board, limit, mintime, minbs1th3, minscorediffcheck,
+                 game=None, policy=None):
+    """ Start search_position() on the engine event loop, returns its future """
+    if isinstance(engine, EngineSupervisor):
+        return engine.start_search(board, limit, mintime, minbs1th3,
+                                   minscorediffcheck, game, policy)
+    return asyncio.run_coroutine_threadsafe(search_position_async(
+            engine, board, limit, mintime, minbs1th3, minscorediffcheck, game,
+            policy), engine_loop())
+
+
+def wait_search(future):
+    """ Wait for a search started by start_search() and return its result """
+    return future.result()
+
+
+async def search_position_async(engine, board, limit, mintime, minbs1th3,
+                                minscorediffcheck, game=None, policy=None):
+    """ Coroutine of search_position(), every info is handled as soon as it arrives """
+    bm1, bm2, depth = None, None, None
+    bs1, bs2 = None, None
+    raw_pv = None
+    t = 0
+    early = False
+    exit_reason = None
+    bestmovechanges = 0  # Start comparing bestmove1 at depth 4
+    tmpmove, oldtmpmove = None, None
+    history = []  # (depth, bs1, bs2, bestmovechanges, time) per depth
+    
+    # Run engine at multipv 2, only the score and pv of the infos are used
+    with await engine.analysis(board, limit, multipv=2, game=game,
+                               info=chess.engine.INFO_SCORE | chess.engine.INFO_PV) as analysis:
+        async for info in analysis:
+            try:
+                multipv = info['multipv']
+                depth = info['depth']
+                if info['score'].is_mate():
+                    s = info['score'].relative.score(mate_score=32000)
+                else:
+                    s = info['score'].relative.score()
+                pv = info['pv'][0:5]
+                t = info['time']
+            
+                if multipv == 1:
+                    bm1 = pv[0]
+                    bs1 = s
+                    raw_pv = pv
+                    
+                    # Exit early if score is below half of minbest1score3
+                    if t >= mintime and bs1 < minbs1th3/2:
+                        logging.warning('Exit search early, current best score is only %s', bs1)
+                        early = True
+                        exit_reason = 'bs1'
+                        break
+                    
+                    # Record bestmove move changes to determine position complexity
+                    if 'depth' in info and 'pv' in info \
+                            and 'score' in info \
+                            and not 'lowerbound' in info \
+                            and not 'upperbound' in info \
+                            and depth >= 4:
+                        tmpmove = info['pv'][0]
+                        if oldtmpmove is not None and tmpmove != oldtmpmove:
+                            bestmovechanges += 1
+                        
+                elif multipv == 2:
+                    bm2 = pv[0]
+                    bs2 = s
+                    
+                    # Both lines of this depth are known
+                    if policy is not None and bs1 is not None:
+                        if history and history[-1][0] == depth:
+                            history.pop()
+                        history.append((depth, bs1, bs2, bestmovechanges, t))
+                        reason = policy.check(history)
+                        if reason is not None:
+                            logging.warning('Exit search early, %s stop at depth %s', reason, depth)
+                            early = True
+                            exit_reason = reason
+                            break
+                    
+                # Save analysis time by exiting it if score difference
+                # between bestscore1 and bestcore2 is way below the
+                # minimum score difference based from user defined
+                # score thresholds
+                if t >= mintime and bs1 is not None and bs2 is not None \
+                        and bs1 - bs2 < minscorediffcheck:
+                    logging.warning('Exit search early, scorediff of %s is below minscorediff of %s',
+                                    bs1 - bs2, minscorediffcheck)
+                    early = True
+                    exit_reason = 'scorediff'
+                    break
+                
+                oldtmpmove = tmpmove
+                
+            except (KeyError):
+                pass
+            except Exception as e:
+                logging.error('Unexpected exception %s in parsing engine analysis', e)
+    
+    return {'bm1': bm1, 'bs1': bs1, 'bm2': bm2, 'bs2': bs2, 'depth': depth,
+            'pv': raw_pv, 'complexity': bestmovechanges, 'time': t,
+            'early': early, 'exit': exit_reason}
+
+
+def exit_key(minbs1th3, minscorediffcheck, policy=None):
+    """ 
+    Returns the early exit parameters of the multipv 2 searches as text, a
+    search that was stopped early is only valid for the same parameters
+    """
+    return 'bs1<{} scorediff<{} {}'.format(minbs1th3/2, minscorediffcheck,
+                                            (policy or StopPolicy()).key())
+
+
+def limit_key(limit):
+    """ Returns (kind, value) of a search limit, kind is depth, nodes or time """
+    if limit.depth is not None:
+        return 'depth', limit.depth
+    if limit.nodes is not None:
+        return 'nodes', limit.nodes
+    return 'time', limit.time
+
+
+class AnalysisCache:
+    """ 
+    Persistent store of the multipv 2 search results in an sqlite file
+    
+    A result is keyed by the epd of the position, the engine name and the
+    search limit. A stored result is returned for a search with the same
+    kind of limit if its limit is at least as large as the one requested.
+    A result from a search that was stopped early is only returned if it
+    has searched at least mintime, the time the current run would also
+    need before it could stop early, and if it was stopped with the same
+    exit parameters, the exit_key() of the bs1 and scorediff exits and the
+    stop policy.
+    
+    When there are more than maxsize results the least recently used ones
+    are removed.
+    """
+    
+    def __init__(self, fn, maxsize=1000000, commit_interval=100):
+        self.maxsize = maxsize
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(fn, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.execute("""CREATE TABLE IF NOT EXISTS analysis (
+                epd TEXT, engine TEXT, kind TEXT, value REAL,
+                bm1 TEXT, bs1 INTEGER, bm2 TEXT, bs2 INTEGER,
+                depth INTEGER, pv TEXT, complexity INTEGER, time REAL,
+                early INTEGER, used INTEGER,
+                PRIMARY KEY (epd, engine, kind, value))""")
+        self.con.execute('CREATE INDEX IF NOT EXISTS analysis_used ON analysis (used)')
+        
+        # Files of older versions have no exit parameters, their early
+        # stopped results are not returned
+        columns = [row[1] for row in self.con.execute('PRAGMA table_info(analysis)')]
+        for column in ('exits', 'exit'):
+            if column not in columns:
+                self.con.execute('ALTER TABLE analysis ADD COLUMN {} TEXT'.format(column))
+        self.size = self.con.execute('SELECT COUNT(*) FROM analysis').fetchone()[0]
+        self.used = self.con.execute('SELECT COALESCE(MAX(used), 0) FROM analysis').fetchone()[0]
+        self.pending = 0
+        
+    def get(self, board, engname, limit, mintime, exits=None):
+        """ 
+        Returns the stored result dict of this position or None, exits is
+        the exit_key() of the searches of the run
+        """
+        kind, value = limit_key(limit)
+        with self.lock:
+            rows = self.con.execute("""SELECT rowid, bm1, bs1, bm2, bs2, depth,
+                    pv, complexity, time, early, exits, exit FROM analysis
+                    WHERE epd = ? AND engine = ? AND kind = ? AND value >= ?
+                    ORDER BY value DESC""",
+                    (board.epd(), engname, kind, value)).fetchall()
+            for row in rows:
+                rowid, bm1, bs1, bm2, bs2, depth, pv, complexity, t, early, row_exits, exit_reason = row
+                if early and (t < mintime or row_exits is None or row_exits != exits):
+                    continue
+                self.hits += 1
+                self.used += 1
+                self.con.execute('UPDATE analysis SET used = ? WHERE rowid = ?',
+                                 (self.used, rowid))
+                self._commit()
+                return {'bm1': chess.Move.from_uci(bm1) if bm1 else None,
+                        'bs1': bs1,
+                        'bm2': chess.Move.from_uci(bm2) if bm2 else None,
+                        'bs2': bs2,
+                        'depth': depth,
+                        'pv': [chess.Move.from_uci(m) for m in pv.split()] if pv else None,
+                        'complexity': complexity,
+                        'time': t,
+                        'early': bool(early),
+                        'exit': exit_reason}
+            self.misses += 1
+            return None
+        
+    def put(self, board, engname, limit, result, exits=None):
+        """ Save the search result dict of this position, searched with the exit_key() exits """
+        kind, value = limit_key(limit)
+        pv = ' '.join(m.uci() for m in result['pv']) if result['pv'] else None
+        with self.lock:
+            self.used += 1
+            self.con.execute("""INSERT OR REPLACE INTO analysis
+                    (epd, engine, kind, value, bm1, bs1, bm2, bs2, depth, pv,
+                     complexity, time, early, used, exits, exit)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (board.epd(), engname, kind, value,
+                     result['bm1'].uci() if result['bm1'] else None, result['bs1'],
+                     result['bm2'].uci() if result['bm2'] else None, result['bs2'],
+                     result['depth'], pv, result['complexity'], result['time'],
+                     int(result['early']), self.used,
+                     exits if result['early'] else None, result.get('exit')))
+            
+            # A replaced result is counted too, recount before evicting
+            self.size += 1
+            if self.size > self.maxsize:
+                self.size = self.con.execute('SELECT COUNT(*) FROM analysis').fetchone()[0]
+                if self.size > self.maxsize:
+                    self._evict()
+            self._commit()
+            
+    def _evict(self):
+        """ Remove the least recently used results, 1/10 of maxsize at a time """
+        n = self.size - self.maxsize + max(1, self.maxsize // 10)
+        self.con.execute("""DELETE FROM analysis WHERE rowid IN
+                (SELECT rowid FROM analysis ORDER BY used LIMIT ?)""", (n,))
+        self.size = self.con.execute('SELECT COUNT(*) FROM analysis').fetchone()[0]
+        logging.info('analysis cache: evicted %s results', n)
+            
+    def _commit(self):
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.con.commit()
+            self.pending = 0
+            
+    def close(self):
+        with self.lock:
+            self.con.commit()
+            self.con.close()
+            
+    def stats(self):
+        """ Returns a one line summary of the cache counters """
+        total = self.hits + self.misses
+        return 'analysis cache: {} hits, {} misses ({:.1f}% hit rate), {} stored results'.format(
+                self.hits, self.misses, 100*self.hits/total if total else 0.0, self.size)
+
+
+class TranspositionIndex:
+    """ 
+    Run-wide index of the searched positions keyed by their zobrist hash
+    
+    The first visit of a position claims it and publishes the search result
+    when done. Later visits, from any game or worker, get the published
+    result, or wait for it if the position is still being searched. If skip
+    is true, the duplicate positions are not saved again.
+    """
+    
+    def __init__(self, skip=False):
+        self.skip = skip
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.saved_time = 0.0
+        
+    def claim(self, key):
+        """ 
+        Returns the search result of the position with zobrist hash key or
+        None if the caller has to search it and then call publish()
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = threading.Event()
+                return None
+            
+        # Another worker is searching this position
+        if isinstance(entry, threading.Event):
+            entry.wait()
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is None:
+                return self.claim(key)
+            
+        with self.lock:
+            self.hits += 1
+            self.saved_time += entry['time']
+        return entry
+    
+    def publish(self, key, result):
+        """ Save the search result of a claimed position, None releases the claim """
+        with self.lock:
+            event = self.entries.pop(key)
+            if result is not None:
+                self.entries[key] = result
+        event.set()
+        
+    def stats(self):
+        """ Returns a one line summary of the index counters """
+        return 'transposition index: {} duplicate positions, {:.1f} engine-seconds saved'.format(
+                self.hits, self.saved_time)
+
+
+class KnownPositions:
+    """ 
+    Zobrist hashes of known positions, like the positions of opening books,
+    that are skipped before the engine is called
+    
+    The hashes are read from polyglot .bin books and epd files. If indexfn is
+    given, they are saved to it with the names, sizes and times of the files,
+    and a later run with the same files reads the index instead.
+    """
+    
+    def __init__(self, fns, indexfn=None):
+        self.lock = threading.Lock()
+        self.hits = 0
+        sources = [[os.path.abspath(fn), os.path.getsize(fn), os.path.getmtime(fn)]
+                   for fn in fns]
+        self.keys = self._load_index(indexfn, sources) if indexfn is not None else None
+        if self.keys is None:
+            self.keys = set()
+            for fn in fns:
+                if fn.lower().endswith('.bin'):
+                    self.keys.update(self.polyglot_keys(fn))
+                else:
+                    self.keys.update(self.epd_keys(fn))
+            if indexfn is not None:
+                self._save_index(indexfn, sources)
+                
+    @staticmethod
+    def polyglot_keys(fn):
+        """ Returns the hashes of a polyglot book, 16 byte entries that start with the big-endian hash """
+        with open(fn, 'rb') as f:
+            data = f.read()
+        return {key for key, in struct.iter_unpack('>Q8x', data[:len(data) - len(data) % 16])}
+    
+    @staticmethod
+    def epd_keys(fn):
+        """ Returns the hashes of the epd or fen lines of fn """
+        keys = set()
+        with open(fn, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    board, _ = chess.Board.from_epd(line)
+                except ValueError:
+                    try:
+                        board = chess.Board(line)
+                    except ValueError:
+                        logging.warning('Skip the line in %s that is not a position: %s', fn, line)
+                        continue
+                keys.add(chess.polyglot.zobrist_hash(board))
+        return keys
+    
+    def _load_index(self, indexfn, sources):
+        """ Returns the hashes of indexfn if it was saved from the files sources, else None """
+        try:
+            with open(indexfn, 'rb') as f:
+                header = json.loads(f.readline())
+                if sources and header['sources'] != sources:
+                    return None
+                keys = array.array('Q')
+                keys.frombytes(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+        if sys.byteorder != header.get('byteorder', sys.byteorder):
+            keys.byteswap()
+        logging.info('Read %s known positions from %s', len(keys), indexfn)
+        return set(keys)
     
-    pcvalue = bn + bb + br + bq + wn + wb + wr + wq
+    def _save_index(self, indexfn, sources):
+        header = {'sources': sources, 'byteorder': sys.byteorder}
+        tmpfn = indexfn + '.tmp'
+        with open(tmpfn, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            array.array('Q', sorted(self.keys)).tofile(f)
+        os.replace(tmpfn, indexfn)
+        
+    def __len__(self):
+        return len(self.keys)
+    
+    def __contains__(self, key):
+        return key in self.keys
+    
+    def skip(self, key):
+        """ Returns true and counts the hit if the position with zobrist hash key is known """
+        if key not in self.keys:
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+    
+    def stats(self, seconds_per_search=0.0):
+        """ Returns a one line summary, the engine time avoided is estimated with seconds_per_search """
+        return 'known positions: {} hashes, {} positions skipped, about {:.1f} engine-seconds avoided'.format(
+                len(self.keys), self.hits, self.hits*seconds_per_search)
+
+
+class ScreeningCascade:
+    """ 
+    A short first search that screens the positions before the full search
+    
+    A position goes on to the full search only if its screening scores,
+    moved by up to margin cp in its favor, could still pass the score
+    thresholds. Every sample-th dropped position is searched in full anyway,
+    to count how many positions the cascade drops that the full search
+    would have saved as interesting.
+    """
+    
+    def __init__(self, limit, margin, minbs1th1, minbs1th2, minbs1th3,
+                 maxbs2th1, maxbs2th2, maxbs2th3, positional=False, sample=0):
+        self.limit = limit
+        self.margin = margin
+        self.thresholds = (minbs1th1, minbs1th2, minbs1th3,
+                           maxbs2th1, maxbs2th2, maxbs2th3)
+        self.positional = positional
+        self.sample = sample
+        self.lock = threading.Lock()
+        self.screened = 0
+        self.passed = 0
+        self.dropped = 0
+        self.sampled = 0
+        self.sampled_kept = 0
+        self.screen_time = 0.0
+        
+    def could_pass(self, bs1, bs2):
+        """ Returns true if bs1 and bs2 could pass the thresholds when moved by margin """
+        minbs1th1, minbs1th2, minbs1th3, maxbs2th1, maxbs2th2, maxbs2th3 = self.thresholds
+        m = self.margin
+        if bs1 + m < minbs1th3 or bs1 - bs2 + 2*m < minbs1th3 - maxbs2th3:
+            return False
+        if not self.positional:
+            # The tiers of interesting_pos()
+            b1, b2 = bs1 + m, bs2 - m
+            if b1 >= minbs1th1:
+                return b2 <= maxbs2th1 or (b1 >= 30000 and b2 <= min(2000, 2*maxbs2th1))
+            if b1 >= minbs1th2:
+                return b2 <= maxbs2th2
+            return b2 <= maxbs2th3
+        
+        # The bands of positional_pos()
+        for lo1, hi1, lo2, hi2 in [(minbs1th1, minbs1th1 + 50, maxbs2th1 - 25, maxbs2th1),
+                                   (minbs1th2, minbs1th1, maxbs2th2 - 25, maxbs2th2),
+                                   (minbs1th3, minbs1th2, maxbs2th3 - 25, maxbs2th3)]:
+            if bs1 + m >= lo1 and bs1 - m <= hi1 and bs2 + m >= lo2 and bs2 - m <= hi2:
+                return True
+        return False
     
-    logging.info('piece value: {}'.format(pcvalue))
+    def check(self, result):
+        """ 
+        Check the result of the screening search, returns (passed, sample),
+        if sample is true the position is searched in full although it did
+        not pass
+        """
+        passed = result['bs1'] is not None and result['bs2'] is not None \
+            and self.could_pass(result['bs1'], result['bs2'])
+        sample = False
+        with self.lock:
+            self.screened += 1
+            self.screen_time += result['time']
+            if passed:
+                self.passed += 1
+            else:
+                self.dropped += 1
+                sample = self.sample > 0 and self.dropped % self.sample == 0
+        logging.info('screening search: bs1 %s, bs2 %s, %s',
+                     result['bs1'], result['bs2'], 'passed' if passed else 'dropped')
+        return passed, sample
+    
+    def sampled_verdict(self, verdict):
+        """ Record the verdict of the full search of a sampled dropped position """
+        with self.lock:
+            self.sampled += 1
+            if verdict == 'interesting':
+                self.sampled_kept += 1
+                
+    def stats(self):
+        """ Returns a one line summary of the cascade counters """
+        text = 'screening: {} positions in {:.1f}s, {} passed to the full search, {} dropped'.format(
+                self.screened, self.screen_time, self.passed, self.dropped)
+        if self.sampled:
+            text += ', {} of {} sampled drops would be interesting ({:.1f}%)'.format(
+                    self.sampled_kept, self.sampled, 100*self.sampled_kept/self.sampled)
+        return text
+
+
+class PgnEvalFilter:
+    """ 
+    Skips positions by the evals of the move comments of the pgn before the
+    engine is called
+    
+    A position is skipped as low if its eval for the side to move, the eval
+    after the previous move, is more than margin cp below minbs1th3, and as
+    flat if flat is not 0 and the game move changes the eval by less than
+    flat cp. Positions without evals are searched, the evals with a depth
+    below depth are not used and count as none. Every sample-th skipped
+    position is searched anyway, to count how many of the skipped positions
+    a full run would have saved.
+    """
+    
+    def __init__(self, minbs1th3, margin=100, flat=0, sample=0, depth=0):
+        self.minbs1th3 = minbs1th3
+        self.margin = margin
+        self.flat = flat
+        self.sample = sample
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.noeval = 0
+        self.skipped = {}
+        self.searched = 0
+        self.sampled = 0
+        self.sampled_verdicts = {}
+        
+    def reason(self, turn, before, after):
+        """ 
+        Returns the reason to skip the position with side to move turn and
+        the evals before and after its game move, None if it is searched
+        """
+        if before is not None and (before if turn == chess.WHITE else -before) \
+                < self.minbs1th3 - self.margin:
+            return 'pgn_eval_low'
+        if self.flat and before is not None and after is not None \
+                and abs(after - before) < self.flat:
+            return 'pgn_eval_flat'
+        return None
+    
+    def check(self, turn, before, after):
+        """ 
+        Check a position like reason() and count it, returns (reason,
+        sample), if sample is true the position is searched although it is
+        skipped
+        """
+        reason = self.reason(turn, before, after)
+        sample = False
+        with self.lock:
+            self.checked += 1
+            if before is None:
+                self.noeval += 1
+            if reason is not None:
+                self.skipped[reason] = self.skipped.get(reason, 0) + 1
+                sample = self.sample > 0 and sum(self.skipped.values()) % self.sample == 0
+                if sample:
+                    self.searched += 1
+        return reason, sample
+    
+    def sampled_verdict(self, verdict):
+        """ Record the verdict of the search of a sampled skipped position """
+        with self.lock:
+            self.sampled += 1
+            verdict = verdict or 'none'
+            self.sampled_verdicts[verdict] = self.sampled_verdicts.get(verdict, 0) + 1
+            
+    def stats(self, seconds_per_search=0.0):
+        """ Returns a one line summary, the engine time avoided is estimated with seconds_per_search """
+        skipped = sum(self.skipped.values())
+        searches = skipped - self.searched
+        text = 'pgn evals: {} positions, {} without eval{}, {} skipped ({}), {} searches and about {:.1f} engine-seconds avoided'.format(
+                self.checked, self.noeval,
+                ' or below depth {}'.format(self.depth) if self.depth else '', skipped,
+                ', '.join('{} {}'.format(k, v) for k, v in sorted(self.skipped.items())) or 'none',
+                searches, searches*seconds_per_search)
+        if self.sampled:
+            interesting = self.sampled_verdicts.get('interesting', 0)
+            text += ', {} of {} sampled skips would be interesting ({:.1f}%) and {} dull'.format(
+                    interesting, self.sampled, 100*interesting/self.sampled,
+                    self.sampled_verdicts.get('dull', 0))
+        return text
+
+
+class Metrics:
+    """ 
+    Run-wide counters and timing histograms of the analysis stages
+    
+    Counters are kept per name and label, for example the skips per reason,
+    and histograms per stage hold the seconds spent in prefilter, screen,
+    search and classify. If jsonfn or promfn is given, a snapshot is saved
+    every interval seconds by a background thread, as json and in the
+    Prometheus text format, and once more on close().
+    """
+    
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    # Prometheus help text and label name of the counters
+    COUNTERS = {
+        'games': ('Games analyzed', None),
+        'positions': ('Positions visited', None),
+        'skips': ('Positions not searched or not saved per reason', 'reason'),
+        'searches': ('Search results per source', 'source'),
+        'exits': ('Engine searches per exit reason', 'reason'),
+        'verdicts': ('Searched positions per verdict', 'verdict'),
+        'engine_seconds': ('Seconds spent in engine searches', None),
+        'saved_seconds': ('Seconds of maxtime saved by early search exits', None),
+        'restarts': ('Engine restarts by the watchdog', None),
+        'requests': ('Server requests per http status', 'status'),
+    }
+    
+    def __init__(self, jsonfn=None, promfn=None, interval=10.0):
+        self.jsonfn = jsonfn
+        self.promfn = promfn
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.start_time = time.perf_counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+        if (jsonfn is not None or promfn is not None) and interval > 0:
+            self.thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self.thread.start()
+        
+    def count(self, name, label=None, value=1):
+        """ Add value to the counter name with label """
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + value
+            
+    def observe(self, stage, seconds):
+        """ Add the seconds of one call of stage to its histogram """
+        with self.lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = {'buckets': [0]*len(self.BUCKETS),
+                                                 'count': 0, 'sum': 0.0}
+            for i, le in enumerate(self.BUCKETS):
+                if seconds <= le:
+                    hist['buckets'][i] += 1
+                    break
+            hist['count'] += 1
+            hist['sum'] += seconds
+            
+    def search_done(self, result, limit, seconds):
+        """ Count an engine search, seconds is its wall time """
+        self.count('engine_seconds', value=seconds)
+        self.count('exits', result.get('exit') or 'limit')
+        if result.get('early') and limit.time is not None:
+            self.count('saved_seconds', value=max(limit.time - seconds, 0.0))
+            
+    def snapshot(self):
+        """ Returns the counters and histograms as a dict """
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            counters = {}
+            for (name, label), value in sorted(self.counters.items(), key=str):
+                if label is None:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[label] = value
+            histograms = {}
+            for stage, hist in self.histograms.items():
+                histograms[stage] = {'buckets': dict(zip([str(le) for le in self.BUCKETS],
+                                                         hist['buckets'])),
+                                     'count': hist['count'], 'sum': hist['sum']}
+        positions = counters.get('positions', 0)
+        return {'time': time.time(),
+                'elapsed': elapsed,
+                'positions_per_sec': positions/elapsed if elapsed > 0 else 0.0,
+                'counters': counters,
+                'histograms': histograms}
+    
+    def prometheus(self):
+        """ Returns the snapshot in the Prometheus text format """
+        snap = self.snapshot()
+        lines = []
+        for name, (text, labelname) in self.COUNTERS.items():
+            metric = 'chiller_{}_total'.format(name)
+            lines.append('# HELP {} {}'.format(metric, text))
+            lines.append('# TYPE {} counter'.format(metric))
+            value = snap['counters'].get(name, 0)
+            if labelname is None:
+                lines.append('{} {}'.format(metric, value))
+            else:
+                for label, v in (value or {}).items():
+                    lines.append('{}{{{}="{}"}} {}'.format(metric, labelname, label, v))
+                    
+        lines.append('# HELP chiller_positions_per_second Positions visited per second')
+        lines.append('# TYPE chiller_positions_per_second gauge')
+        lines.append('chiller_positions_per_second {}'.format(snap['positions_per_sec']))
+        
+        lines.append('# HELP chiller_stage_seconds Seconds spent per call of each stage')
+        lines.append('# TYPE chiller_stage_seconds histogram')
+        for stage, hist in sorted(snap['histograms'].items()):
+            cumulative = 0
+            for le, n in hist['buckets'].items():
+                cumulative += n
+                lines.append('chiller_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                        stage, le, cumulative))
+            lines.append('chiller_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(
+                    stage, hist['count']))
+            lines.append('chiller_stage_seconds_sum{{stage="{}"}} {}'.format(stage, hist['sum']))
+            lines.append('chiller_stage_seconds_count{{stage="{}"}} {}'.format(stage, hist['count']))
+        return '\n'.join(lines) + '\n'
+    
+    def save(self):
+        """ Write the json and Prometheus files, readers never see a partial file """
+        for fn, text in [(self.jsonfn, lambda: json.dumps(self.snapshot(), indent=2)),
+                         (self.promfn, self.prometheus)]:
+            if fn is None:
+                continue
+            tmpfn = fn + '.tmp'
+            with open(tmpfn, 'w') as f:
+                f.write(text())
+            os.replace(tmpfn, fn)
+            
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.save()
+            except OSError as e:
+                logging.error('Failed to save the metrics: %s', e)
+                
+    def close(self):
+        """ Stop the background thread and save the final snapshot """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.jsonfn is not None or self.promfn is not None:
+            self.save()
+            
+    def stats(self):
+        """ Returns a one line summary of the engine time and skips """
+        snap = self.snapshot()
+        counters = snap['counters']
+        skips = ', '.join('{} {}'.format(k, v) for k, v in counters.get('skips', {}).items())
+        text = 'metrics: {} positions ({:.1f}/s), {:.1f} engine-seconds, {:.1f}s saved by early exits, skips: {}'.format(
+                counters.get('positions', 0), snap['positions_per_sec'],
+                counters.get('engine_seconds', 0.0), counters.get('saved_seconds', 0.0),
+                skips or 'none')
+        if counters.get('restarts'):
+            text += ', engine restarts: {}'.format(counters['restarts'])
+        return text
+
+
+class ColumnWriter:
+    """ 
+    Saves the searched positions with the values used by classify_position
+    in a columnar file, so that they can be classified again with other
+    thresholds by the reclassify command, without the engine
+    
+    The file is a sequence of chunks, a chunk is one numpy array per column
+    in the order of COLUMNS. The rows are buffered and a chunk is appended
+    when chunk_size rows are buffered, on sync() and on close(). It is
+    thread-safe, so several workers can add to it.
+    """
+    
+    # Column names and numpy types, epd is the saved epd line
+    COLUMNS = (('bs1', 'i4'), ('bs2', 'i4'), ('depth', 'i2'),
+               ('complexity', 'i2'), ('pcval', 'i2'), ('capture', '?'),
+               ('promote', '?'), ('time', 'f4'), ('game', 'i4'),
+               ('ply', 'i2'), ('epd', 'S'))
+    
+    def __init__(self, fn, chunk_size=10000):
+        self.fn = fn
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.rows = []
+        self.saved = 0
+        
+    def add(self, row):
+        """ Add a row, a tuple with the values of COLUMNS """
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) >= self.chunk_size:
+                self._flush()
+                
+    def _flush(self):
+        if not self.rows:
+            return
+        buf = io.BytesIO()
+        for (name, dtype), values in zip(self.COLUMNS, zip(*self.rows)):
+            if dtype == 'S':
+                values = [v.encode('utf-8') for v in values]
+            np.save(buf, np.array(values, dtype=dtype))
+        with open(self.fn, 'ab') as f:
+            f.write(buf.getvalue())
+        self.saved += len(self.rows)
+        self.rows = []
+        
+    def sync(self):
+        """ Write the buffered rows, returns {file name: size} like OutputWriter.sync() """
+        with self.lock:
+            self._flush()
+            return {self.fn: os.path.getsize(self.fn) if os.path.exists(self.fn) else 0}
+            
+    def close(self):
+        with self.lock:
+            self._flush()
+            
+    def stats(self):
+        return 'columns: {} rows saved to {}'.format(self.saved, self.fn)
+
+
+def load_columns(fn):
+    """ Returns {column name: numpy array} of all chunks in the columnar file fn """
+    parts = {name: [] for name, _ in ColumnWriter.COLUMNS}
+    with open(fn, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            try:
+                chunk = [np.load(f) for _ in ColumnWriter.COLUMNS]
+            except (ValueError, EOFError, OSError):
+                # A chunk that was not completely written by an interrupted run
+                logging.warning('Skip the incomplete chunk at the end of %s', fn)
+                break
+            for (name, _), values in zip(ColumnWriter.COLUMNS, chunk):
+                parts[name].append(values)
+    return {name: np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=dtype)
+            for name, dtype in ColumnWriter.COLUMNS}
+
+
+def position_epd(board, result, engname, c0_val=None, g_move=None):
+    """ Returns the epd of a searched position, the opcodes have the search result """
+    operations = dict(bm = result['bm1'], ce = result['bs1'])
+    if g_move is not None:
+        operations['sm'] = g_move
+    operations.update(
+                acd = result['depth'],
+                acs = int(result['time']),
+                fmvn = board.fullmove_number,
+                hmvc = board.halfmove_clock,
+                pv = result['pv'])
+    if c0_val is not None:
+        operations['c0'] = c0_val
+    operations.update(
+                c1 = 'Complexity: ' + str(result['complexity']),
+                c2 = 'bestscore2: ' + str(result['bs2']),
+                c3 = 'Analyzing engine: ' + engname)
+    return board.epd(**operations)
+
+
+def plan_game(game, start_move, minpiecevalue=0, maxpiecevalue=62, pin=False,
+              resume_ply=None, evals=False, metrics=None, done=None, eval_depth=0):
+    """ 
+    Returns the GamePlan of game, the prefilter skips are logged and counted
+    in metrics if it is not None
+    """
+    t0 = time.perf_counter()
+    plan = GamePlan(game, start_move, minpiecevalue, maxpiecevalue, pin,
+                    resume_ply, evals=evals, done=done, eval_depth=eval_depth)
+    if metrics is not None:
+        metrics.observe('plan', time.perf_counter() - t0)
+        metrics.count('positions', value=plan.visited)
+        for reason, count in plan.skip_counts().items():
+            metrics.count('skips', reason, count)
+            
+    # piece value, pin and check conditions
+    for _, reason, pcval in plan.skipped:
+        if reason == 'minpiecevalue':
+            logging.warning('Skip this pos piece value %s is below minimmum of %s', pcval, minpiecevalue)
+        elif reason == 'maxpiecevalue':
+            logging.warning('Skip this pos and game piece value %s is above maximum of %s', pcval, maxpiecevalue)
+        elif reason == 'pin':
+            logging.warning('Skip this pos no piece of not stm is pinned')
+        elif reason == 'check':
+            logging.warning('Skip this pos, stm is in check')
+    if plan.cut == 'start_move':
+        logging.warning('move start limit is reached, exit from this game')
+    return plan
+
+
+def analyze_game(game, engine, enginefn, hash_val, thread_val,
+                 analysis_start_move_num, outepdfn, gcnt, engname,
+                 dullfn, outpgnfn,
+                 mintime=5.0, maxtime=15.0, minscorediffcheck=25,
+                 minbs1th1=2000, minbs1th2=1000, minbs1th3=500,
+                 maxbs2th1=300, maxbs2th2=200, maxbs2th3=100,
+                 weightsfile=None, skipdraw=False, pin=False,
+                 positional=False, minpiecevalue=0, maxpiecevalue=62,
+                 disable_complexity=False, save_last_move=False,
+                 emit=append_to_file, cache=None, tpindex=None,
+                 resume_ply=None, progress=None, cascade=None, done_plies=None,
+                 screen_engine=None, screen_engname=None, metrics=None,
+                 progress_interval=0.5, session=False, prefetch=False,
+                 source_of=None, columns=None, known=None, stop_policy=None,
+                 ply_order='reverse', pgn_eval=None, plan=None, plies=None):
+    """ 
+    Analyze positons in the game and save interesting and dull positions to a file
+    
+    emit: function called as emit(filename, text) for every output record,
+        by default the text is appended to the file right away
+    cache: AnalysisCache, if not None the stored searches are used instead
+        of running the engine
+    tpindex: TranspositionIndex, if not None a position is searched only
+        once in the whole run
+    resume_ply: if not None, the positions after this ply were already
+        analyzed in an earlier run and are skipped
+    done_plies: if not None, the plies up to resume_ply that were already
+        analyzed in an earlier run, they are skipped too
+    progress: function called as progress(gcnt, ply, done) when all
+        positions after ply and the positions of the plies in done are done
+    cascade: ScreeningCascade, if not None the position is searched first by
+        screen_engine, or engine if it is None, with the cascade limit
+    metrics: Metrics, if not None the positions, skips, searches and stage
+        times are counted in it
+    progress_interval: the position counter is printed at most once per
+        this many seconds
+    session: if true the searches of the game are in one engine game, the
+        engine gets ucinewgame only before the first one
+    prefetch: if true the search of the next position is started as soon
+        as the search of this position is done, not used with cache,
+        tpindex or cascade
+    source_of: if not None, function that returns the pgn file of game
+        gcnt, the file is added to c0
+    columns: ColumnWriter, if not None every classified position is added
+        to it, also the ones that are not saved
+    known: KnownPositions, if not None the positions in it are not searched
+    stop_policy: StopPolicy, if not None it can stop the full searches
+        early in addition to the bs1 and scorediff exits
+    ply_order: reverse to search the positions from the end of the game,
+        priority in the order of GamePlan.by_priority()
+    pgn_eval: PgnEvalFilter, if not None the evals of the move comments are
+        read and the positions it skips are not searched
+    plan: GamePlan of the game made by plan_game(), if None it is made here
+    plies: if not None, only these plies of the plan are analyzed, in this
+        order
+    """
+
+    limit = chess.engine.Limit(time=maxtime)
+    
+    # Copy orig game header to our epd output
+    ev = game.headers['Event']
+    si = game.headers['Site']
+    da = game.headers['Date']
+    ro = game.headers['Round']
+    wp = game.headers['White']
+    bp = game.headers['Black']
+    res = game.headers['Result']
+    
+    # If result of this game is a draw and skipdraw is true, we skip it
+    if skipdraw and res == '1/2-1/2':
+        return
+    
+    if metrics is not None and plan is None:
+        metrics.count('games')
+    
+    c0_val = wp + ' - ' + bp + ', ' + ev + ', ' + si + ', ' + da + ', R' + ro 
+    if source_of is not None:
+        c0_val += ', ' + source_of(gcnt)
+    
+    poscnt = 0   
+    
+    # The arguments of the info logs are costly, skip them if not logged
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+    last_progress = 0.0
+    
+    # The engine game of the searches, None keeps the game of the last search
+    session_game = game if session else None
+    
+    # (ply, future, start time) of the search of the next position
+    prefetched = None
+    if cache is not None or tpindex is not None or cascade is not None:
+        prefetch = False
+        
+    # The early exits of the searches, stored with the searches in the cache
+    exits = exit_key(minbs1th3, minscorediffcheck, stop_policy)
+    
+    # The positions to search, found in one forward pass over the game
+    if plan is None:
+        plan = plan_game(game, analysis_start_move_num, minpiecevalue, maxpiecevalue,
+                         pin, resume_ply, evals=pgn_eval is not None, metrics=metrics,
+                         done=done_plies,
+                         eval_depth=pgn_eval.depth if pgn_eval is not None else 0)
+        
+    if plies is None:
+        plies = plan.by_priority() if ply_order == 'priority' else plan.eligible
+    pending = set(plies)
+    
+    for i, ply in enumerate(plies):
+        # The positions from the ply after the highest one not done yet are
+        # done, and with the priority order some plies below it
+        if progress is not None and i > 0:
+            pending.discard(plies[i - 1])
+            bound = max(pending) + 1
+            progress(gcnt, bound, [p for p in plies[:i] if p < bound])
+            
+        board = plan.boards.pop(ply)
+        curboard = board
+        g_move = plan.move_at(ply)
+        pcval = plan.material_at(ply)
+        fen = curboard.fen()
+        
+        # Print the fen before g_move is made on the board
+        poscnt += 1  
+        
+        now = time.monotonic()
+        if now - last_progress >= progress_interval:
+            last_progress = now
+            print('game {} / position {} \r'.format(gcnt, poscnt), end='')
+        
+        if log_info:
+            logging.info('game %s / position %s', gcnt, poscnt)
+            logging.info('%s', board.fen())
+            logging.info('game move: %s', curboard.san(g_move))
+            logging.info('piece value: %s', pcval)
+        
+        key = None
+        if known is not None or tpindex is not None:
+            key = chess.polyglot.zobrist_hash(board)
+            
+        # Positions of the opening books or epd files of known positions
+        if known is not None and known.skip(key):
+            logging.warning('Skip this pos, it is a known position')
+            if metrics is not None:
+                metrics.count('skips', 'known')
+            continue
+        
+        # Positions where the evals of the pgn show no chance to be saved
+        eval_sample = False
+        if pgn_eval is not None:
+            reason, eval_sample = pgn_eval.check(board.turn, *plan.evals_at(ply))
+            if reason is not None and not eval_sample:
+                logging.warning('Skip this pos, %s by the evals of the pgn', reason)
+                if metrics is not None:
+                    metrics.count('skips', reason)
+                continue
+        
+        # A position that was already analyzed in this run is not searched
+        # again, if it is still searched by another worker we wait for it.
+        result = None
+        if tpindex is not None:
+            result = tpindex.claim(key)
+            if result is not None:
+                if metrics is not None:
+                    metrics.count('searches', 'duplicate')
+                if tpindex.skip:
+                    logging.warning('Skip this pos, it was already analyzed in this run')
+                    if metrics is not None:
+                        metrics.count('skips', 'duplicate')
+                    continue
+                logging.info('Found in transposition index')
+                
+        sample = False
+        if result is None:
+            try:
+                # Use the stored search of this position if there is one
+                if cache is not None:
+                    result = cache.get(board, engname, limit, mintime, exits)
+                    if result is not None and metrics is not None:
+                        metrics.count('searches', 'cache')
+                    
+                # Run a short search first, the position is dropped if it
+                # has no chance to be saved
+                if result is None and cascade is not None:
+                    screen_result = None
+                    if cache is not None:
+                        screen_result = cache.get(board, screen_engname or engname,
+                                                  cascade.limit, 0)
+                    if screen_result is None:
+                        t0 = time.perf_counter()
+                        screen_result = search_position(screen_engine or engine, board,
+                                                        cascade.limit, float('inf'), 0, 0,
+                                                        game=session_game)
+                        if metrics is not None and screen_result is not None:
+                            seconds = time.perf_counter() - t0
+                            metrics.count('searches', 'screen')
+                            metrics.observe('screen', seconds)
+                            metrics.search_done(screen_result, cascade.limit, seconds)
+                        if cache is not None and screen_result is not None:
+                            cache.put(board, screen_engname or engname,
+                                      cascade.limit, screen_result)
+                            
+                    # A position rejected by the watchdog of the screening
+                    # engine gets the full search
+                    if screen_result is not None:
+                        passed, sample = cascade.check(screen_result)
+                        if not passed and not sample:
+                            result = dict(screen_result, dropped=True)
+                    
+                if result is None:
+                    # Run engine in multipv 2
+                    logging.info('%s is searching at multipv %s for %ss ...',
+                                 engname, 2, maxtime)
+                    t0 = time.perf_counter()
+                    if prefetched is not None and prefetched[0] == board.ply():
+                        result = wait_search(prefetched[1])
+                        t0 = prefetched[2]
+                        prefetched = None
+                    else:
+                        result = search_position(engine, board, limit, mintime,
+                                                 minbs1th3, minscorediffcheck,
+                                                 game=session_game,
+                                                 policy=stop_policy)
+                    if metrics is not None and result is not None:
+                        seconds = time.perf_counter() - t0
+                        metrics.count('searches', 'engine')
+                        metrics.observe('search', seconds)
+                        metrics.search_done(result, limit, seconds)
+                    if cache is not None and result is not None:
+                        cache.put(board, engname, limit, result, exits)
+                else:
+                    logging.info('Found in analysis cache')
+            finally:
+                if tpindex is not None:
+                    tpindex.publish(key, result)
+                    
+        # The engine failed on this position, it was saved to the reject file
+        if result is None:
+            logging.warning('Skip this pos, it was rejected by the engine watchdog')
+            if metrics is not None:
+                metrics.count('skips', 'reject')
+            continue
+            
+        # Start the search of the next position, the engine searches it
+        # while this one is classified and saved
+        if prefetch and prefetched is None and i + 1 < len(plies):
+            next_board = plan.boards[plies[i + 1]]
+            if (known is None or chess.polyglot.zobrist_hash(next_board) not in known) \
+                    and (pgn_eval is None
+                         or pgn_eval.reason(next_board.turn, *plan.evals_at(plies[i + 1])) is None):
+                prefetched = (next_board.ply(),
+                              start_search(engine, next_board, limit, mintime,
+                                           minbs1th3, minscorediffcheck,
+                                           game=session_game,
+                                           policy=stop_policy),
+                              time.perf_counter())
+                    
+        if result.get('dropped'):
+            logging.warning('Skip this pos, it was dropped by the screening search')
+            if metrics is not None:
+                metrics.count('skips', 'screen')
+            continue
+            
+        bm1, bs1 = result['bm1'], result['bs1']
+        bm2, bs2 = result['bm2'], result['bs2']
+        depth = result['depth']
+        bestmovechanges, t = result['complexity'], result['time']
+
+        # The search exited on the best score 1 before the second best move
+        # was found, it is skipped like by classify_position()
+        if bs2 is None and bs1 is not None and bs1 < minbs1th3:
+            logging.warning('Skip this pos, score %s is below minbs1th3 of %s', bs1, minbs1th3)
+            if metrics is not None:
+                metrics.count('skips', 'bs1')
+            continue
+        
+        # The search exited before the second best move was found or there
+        # is only one legal move
+        if bs1 is None or bs2 is None:
+            logging.warning('Skip this pos, the search has no second best score')
+            if metrics is not None:
+                metrics.count('skips', 'nobs2')
+            continue
+
+        if log_info:
+            logging.info('Search is done!!')
+            logging.info('game move       : %s (%s)', g_move, curboard.san(g_move))
+            logging.info('complexity      : %s', bestmovechanges)
+            logging.info('best move 1     : %s, best score 1: %s', bm1, bs1)
+            logging.info('best move 2     : %s, best score 2: %s', bm2, bs2)
+            logging.info('scorediff       : %s', bs1 - bs2)
+        
+        t0 = time.perf_counter()
+        verdict = classify_position(board, bs1, bs2, bm1, bestmovechanges,
+                                    minbs1th1, minbs1th2, minbs1th3,
+                                    maxbs2th1, maxbs2th2, maxbs2th3,
+                                    positional=positional,
+                                    disable_complexity=disable_complexity,
+                                    metrics=metrics)
+        if metrics is not None:
+            metrics.observe('classify', time.perf_counter() - t0)
+            if verdict is not None:
+                metrics.count('verdicts', verdict)
+        if sample:
+            cascade.sampled_verdict(verdict)
+        if eval_sample:
+            pgn_eval.sampled_verdict(verdict)
+        if verdict is None and columns is None:
+            continue
+                
+        # Create new epd
+        new_epd = position_epd(board, result, engname, c0_val, g_move)
+        
+        if columns is not None:
+            columns.add((bs1, bs2, depth or 0, bestmovechanges, pcval,
+                         board.is_capture(bm1), bm1.promotion is not None,
+                         t, gcnt, board.ply(), new_epd))
+            if verdict is None:
+                continue
+        is_save = verdict == 'interesting'
+        
+        # Save this new epd to either interesting.epd or dull.epd
+        if is_save:
+            logging.info('Save this position to %s', outepdfn)
+            emit(outepdfn, '{}\n'.format(new_epd))
+                
+            save_as_pgn(outpgnfn, curboard, game, fen, bm1, save_last_move,
+                        emit=emit)
+        else:
+            # Save all pos to dull.epd that were analyzed to a maxtime but
+            # failed to be saved in interesting.epd. It can be useful to
+            # improve the algorith by examing these positions visually.
+            logging.info('Saved to %s', dullfn)
+            emit(dullfn, '{}\n'.format(new_epd))
+
+    
+def build_pgn_index(pgnfn):
+    """ Returns the byte offsets of the games in pgnfn, found in one pass over the file """
+    offsets = []
+    offset = 0
+    in_headers = False
+    with open(pgnfn, 'rb') as f:
+        for line in f:
+            if line.startswith(b'[') or (offset == 0 and line.startswith(codecs.BOM_UTF8 + b'[')):
+                if not in_headers:
+                    offsets.append(offset)
+                    in_headers = True
+            elif not line.startswith(b'%'):
+                in_headers = False
+            offset += len(line)
+    return offsets
+
+
+def pgn_index(pgnfn):
+    """ 
+    Returns the byte offsets of the games in pgnfn
+    
+    The offsets are saved in the file pgnfn.idx next to the pgn file, they
+    are read from it if the size and modification time of the pgn file did
+    not change.
+    """
+    idxfn = pgnfn + '.idx'
+    st = os.stat(pgnfn)
+    stamp = '{} {}'.format(st.st_size, st.st_mtime_ns)
+    try:
+        with open(idxfn, 'r') as f:
+            if f.readline().strip() == stamp:
+                return [int(line) for line in f]
+    except (OSError, ValueError):
+        pass
+    
+    offsets = build_pgn_index(pgnfn)
+    try:
+        with open(idxfn, 'w') as f:
+            f.write('{}\n'.format(stamp))
+            f.writelines('{}\n'.format(offset) for offset in offsets)
+    except OSError as e:
+        logging.warning('Cannot save pgn index %s: %s', idxfn, e)
+    return offsets
+
+
+def parse_game_range(text):
+    """ Returns (first, last) of the game numbers range a-b, a- or a, last may be None """
+    first, sep, last = text.partition('-')
+    first = int(first) if first.strip() else 1
+    if not sep:
+        return first, first
+    return first, int(last) if last.strip() else None
+
+
+class OutputWriter:
+    """ 
+    Buffered writer of the output files that keeps the files open
+    
+    The text of the records is buffered and written when flush_size bytes
+    are buffered or flush_interval seconds have passed since the last
+    flush. It is thread-safe, so several workers can write to it.
+    
+    kinds maps the output file names to the record types interesting, dull
+    and pgn. If combinedfn is not None, all records are written to that
+    file instead, as json lines if its name ends with .jsonl or else as epd
+    lines with the record type in opcode c4, pgn records are then dropped.
+    """
+    
+    def __init__(self, kinds, flush_interval=5.0, flush_size=65536,
+                 combinedfn=None):
+        self.kinds = kinds
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.combinedfn = combinedfn
+        self.jsonl = combinedfn is not None and combinedfn.endswith('.jsonl')
+        self.lock = threading.Lock()
+        self.handles = {}
+        self.buffers = {}
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+        
+    def files(self):
+        """ Returns the names of the files written by this writer """
+        if self.combinedfn is not None:
+            return [self.combinedfn]
+        return list(self.kinds)
+        
+    def write(self, fn, text):
+        """ Add the text of a record for file fn, this is an emit function of analyze_game """
+        self.write_records([(fn, text)])
+        
+    def write_records(self, records):
+        """ Add the (fn, text) records, they are written together """
+        with self.lock:
+            for fn, text in records:
+                if self.combinedfn is not None:
+                    fn, text = self.combinedfn, self._combined(fn, text)
+                    if text is None:
+                        continue
+                self.buffers.setdefault(fn, []).append(text)
+                self.buffered += len(text)
+            if self.buffered >= self.flush_size \
+                    or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+                
+    def _combined(self, fn, text):
+        kind = self.kinds.get(fn, fn)
+        if self.jsonl:
+            return json.dumps({'type': kind, 'text': text.rstrip('\n')}) + '\n'
+        if kind == 'pgn':
+            return None
+        return '{} c4 "{}";\n'.format(text.rstrip('\n'), kind)
+                
+    def _flush(self):
+        for fn, texts in self.buffers.items():
+            f = self.handles.get(fn)
+            if f is None:
+                f = self.handles[fn] = open(fn, 'a')
+            f.write(''.join(texts))
+            f.flush()
+        self.buffers = {}
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+        
+    def flush(self):
+        with self.lock:
+            self._flush()
+            
+    def sync(self):
+        """ Write the buffered records to disk, returns {file name: size} """
+        with self.lock:
+            self._flush()
+            for f in self.handles.values():
+                os.fsync(f.fileno())
+            return {fn: self.handles[fn].tell() if fn in self.handles
+                    else (os.path.getsize(fn) if os.path.exists(fn) else 0)
+                    for fn in self.files()}
+            
+    def close(self):
+        with self.lock:
+            self._flush()
+            for f in self.handles.values():
+                f.close()
+            self.handles = {}
+
+
+class Checkpoint:
+    """ 
+    Progress of the run that is saved in a json file, so that an interrupted
+    run can be resumed without duplicate output
+    
+    It is saved after a position or game is done if interval seconds have
+    passed since the last save, the output of the writer is synced to disk
+    first. The rows of columns, a ColumnWriter, are synced with them.
+    
+    next_game: every game before it is done
+    finished: numbers of the games after next_game that are done
+    plies: {game number: ply}, the positions after ply are done
+    done: {game number: plies}, the positions of these plies below the ply
+        of plies are done too
+    sizes: sizes of the output files when the checkpoint was saved
+    
+    If fn is None the progress is kept but not saved.
+    """
+    
+    def __init__(self, fn, pgnfn, writer, interval=0.0, columns=None):
+        self.fn = fn
+        self.pgnfn = pgnfn
+        self.writer = writer
+        self.columns = columns
+        self.interval = interval
+        self.last_save = None
+        self.next_game = 1
+        self.finished = set()
+        self.plies = {}
+        self.done = {}
+        self.started = set()
+        self.last_started = 0
+        self.lock = threading.Lock()
+        
+    def load(self):
+        """ Read the progress of an earlier run, returns false if there is none """
+        try:
+            with open(self.fn, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data['pgn'] != self.pgnfn:
+            logging.warning('Checkpoint %s is for pgn file %s', self.fn, data['pgn'])
+            return False
+        self.next_game = data['next_game']
+        self.finished = set(data['finished'])
+        self.plies = {int(k): v for k, v in data['plies'].items()}
+        self.done = {int(k): set(v) for k, v in data.get('done', {}).items()}
+        self.last_started = self.next_game - 1
+        
+        # Remove the output that was written after the checkpoint
+        for fn, size in data['sizes'].items():
+            cursize = os.path.getsize(fn) if os.path.exists(fn) else 0
+            if cursize > size:
+                with open(fn, 'r+') as f:
+                    f.truncate(size)
+            elif cursize < size:
+                logging.warning('%s is smaller than at the checkpoint', fn)
+        return True
+        
+    def is_done(self, gcnt):
+        return gcnt < self.next_game or gcnt in self.finished
+    
+    def game_started(self, gcnt):
+        with self.lock:
+            self.started.add(gcnt)
+            self.last_started = max(self.last_started, gcnt)
+            
+    def position_done(self, gcnt, ply, done=()):
+        with self.lock:
+            self.plies[gcnt] = ply
+            if done:
+                self.done[gcnt] = set(done) | self.done.get(gcnt, set())
+            self.save()
+            
+    def game_done(self, gcnt):
+        with self.lock:
+            self.started.discard(gcnt)
+            self.plies.pop(gcnt, None)
+            self.done.pop(gcnt, None)
+            self.finished.add(gcnt)
+            self.next_game = min(self.started) if self.started else self.last_started + 1
+            self.finished = {g for g in self.finished if g > self.next_game}
+            self.save()
+            
+    def save(self, force=False):
+        if self.fn is None:
+            return
+        now = time.monotonic()
+        if not force and self.last_save is not None \
+                and now - self.last_save < self.interval:
+            return
+        self.last_save = now
+        sizes = self.writer.sync()
+        if self.columns is not None:
+            sizes.update(self.columns.sync())
+        data = {'pgn': self.pgnfn,
+                'next_game': self.next_game,
+                'finished': sorted(self.finished),
+                'plies': self.plies,
+                'done': {g: sorted(plies) for g, plies in self.done.items()},
+                'sizes': sizes}
+        tmpfn = self.fn + '.tmp'
+        with open(tmpfn, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfn, self.fn)
+        
+    def close(self):
+        """ Save the final progress of the run """
+        with self.lock:
+            self.save(force=True)
+
+
+class GameFilter:
+    """ 
+    Filters on the game headers, applied before the moves of a game are parsed
+    
+    Elo limits apply to both players, a game without Elo does not pass them.
+    Dates are compared as strings in pgn format, yyyy.mm.dd. The ply count is
+    taken from the PlyCount header, or from the moves if there is none.
+    """
+    
+    def __init__(self, skipdraw=False, minelo=None, maxelo=None, event=None,
+                 mindate=None, maxdate=None, minply=None, maxply=None):
+        self.skipdraw = skipdraw
+        self.minelo = minelo
+        self.maxelo = maxelo
+        self.event = event.lower() if event is not None else None
+        self.mindate = mindate
+        self.maxdate = maxdate
+        self.minply = minply
+        self.maxply = maxply
+        
+    def headers_pass(self, headers):
+        """ Returns true if the game with these headers should be analyzed """
+        if self.skipdraw and headers.get('Result') == '1/2-1/2':
+            return False
+        
+        if self.minelo is not None or self.maxelo is not None:
+            for tag in ['WhiteElo', 'BlackElo']:
+                try:
+                    elo = int(headers.get(tag))
+                except (TypeError, ValueError):
+                    return False
+                if self.minelo is not None and elo < self.minelo:
+                    return False
+                if self.maxelo is not None and elo > self.maxelo:
+                    return False
+                
+        if self.event is not None and self.event not in headers.get('Event', '').lower():
+            return False
+        
+        date = headers.get('Date', '????.??.??')
+        if self.mindate is not None and date < self.mindate:
+            return False
+        if self.maxdate is not None and date > self.maxdate:
+            return False
+        
+        if 'PlyCount' in headers:
+            try:
+                return self.ply_pass(int(headers['PlyCount']))
+            except ValueError:
+                pass
+            
+        return True
+    
+    def game_pass(self, game):
+        """ Returns true if the parsed game should be analyzed """
+        if 'PlyCount' in game.headers or (self.minply is None and self.maxply is None):
+            return True
+        return self.ply_pass(game.end().ply())
+    
+    def ply_pass(self, plycount):
+        if self.minply is not None and plycount < self.minply:
+            return False
+        if self.maxply is not None and plycount > self.maxply:
+            return False
+        return True
+    
+    
+class GameReader:
+    """ 
+    Iterates over the (gcnt, game) items of the games in pgn that pass the
+    game_filter, gcnt is the game number in the pgn file plus base. After
+    the iteration gcnt is the number of the last game read.
+    
+    The headers of a game are read first and its moves are parsed only if
+    the headers pass the filter. If pgn is not seekable every game is
+    parsed.
+    
+    Only the games from number first to last are read, with the byte offsets
+    of the games the reader seeks to the first one. The games with a number
+    in skip are not parsed.
+    """
+    
+    def __init__(self, pgn, game_filter=None, first=1, last=None,
+                 offsets=None, skip=None, base=0):
+        self.pgn = pgn
+        self.game_filter = game_filter if game_filter is not None else GameFilter()
+        self.first = first
+        self.last = last
+        self.offsets = offsets
+        self.skip = skip if skip is not None else set()
+        self.base = base
+        self.gcnt = base
+        self.skimmed = 0
+        self.parsed = 0
+        self.skim_time = 0.0
+        self.parse_time = 0.0
+        
+    def __iter__(self):
+        pgn = self.pgn
+        seekable = pgn.seekable()
+        gcnt = self.base
+        if self.first > gcnt + 1:
+            if self.offsets is not None:
+                if self.first > len(self.offsets):
+                    return
+                pgn.seek(self.offsets[self.first - 1])
+                gcnt = self.first - 1
+            else:
+                while gcnt < self.first - 1 and chess.pgn.skip_game(pgn):
+                    gcnt += 1
+                self.gcnt = gcnt
+                    
+        while self.last is None or gcnt < self.last:
+            if seekable:
+                t0 = time.perf_counter()
+                offset = pgn.tell()
+                headers = chess.pgn.read_headers(pgn)
+                self.skim_time += time.perf_counter() - t0
+                if headers is None:
+                    break
+                gcnt += 1
+                self.gcnt = gcnt
+                self.skimmed += 1
+                if gcnt in self.skip or not self.game_filter.headers_pass(headers):
+                    continue
+                pgn.seek(offset)
+                
+            t0 = time.perf_counter()
+            game = chess.pgn.read_game(pgn)
+            self.parse_time += time.perf_counter() - t0
+            if game is None:
+                break
+            self.parsed += 1
+            if not seekable:
+                gcnt += 1
+                self.gcnt = gcnt
+                if gcnt in self.skip or not self.game_filter.headers_pass(game.headers):
+                    continue
+            if not self.game_filter.game_pass(game):
+                continue
+            
+            yield gcnt, game
+            
+    def stats(self):
+        """ Returns a one line summary of the reading speed """
+        return 'pgn reader: skimmed {} games in {:.1f}s ({:.0f} games/s), parsed {} games in {:.1f}s ({:.0f} games/s)'.format(
+                self.skimmed, self.skim_time, self.skimmed/self.skim_time if self.skim_time else 0.0,
+                self.parsed, self.parse_time, self.parsed/self.parse_time if self.parse_time else 0.0)
+
+
+PGN_SUFFIXES = ('.pgn', '.pgn.gz', '.pgn.bz2', '.pgn.zst')
+
+
+def pgn_files(spec):
+    """ 
+    Returns the sorted list of pgn files of spec, a file, a directory whose
+    files ending in .pgn, .pgn.gz, .pgn.bz2 or .pgn.zst are read, or a glob
+    pattern
+    """
+    if os.path.isdir(spec):
+        files = []
+        for root, dirs, names in os.walk(spec):
+            dirs.sort()
+            files += [os.path.join(root, name) for name in sorted(names)
+                      if name.lower().endswith(PGN_SUFFIXES)]
+        return files
+    if glob.has_magic(spec):
+        return sorted(glob.glob(spec))
+    return [spec]
+
+
+def is_compressed(fn):
+    return fn.lower().endswith(('.gz', '.bz2', '.zst'))
+
+
+class ReadAheadReader:
+    """ 
+    A text stream over the file object f that is read by a background thread
+    
+    The thread reads chunks of chunk_size characters into a queue of up to
+    depth chunks, so the decompression of f runs while the games are
+    parsed. Only readline() is provided, as used by chess.pgn, and a tell()
+    and seek() back to the position of the last tell(), as used by
+    GameReader to read the headers of a game first.
+    """
+    
+    def __init__(self, f, chunk_size=1 << 20, depth=8):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=depth)
+        self.buffer = ''
+        self.pos = 0     # Position of the next line in buffer
+        self.offset = 0  # Stream position of buffer[0]
+        self.mark = None
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._read, name='readahead', daemon=True)
+        self.thread.start()
+        
+    def _read(self):
+        try:
+            while not self.closed:
+                chunk = self.f.read(self.chunk_size)
+                self.queue.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self.queue.put(e)
+            
+    def _fill(self):
+        """ Append the next chunk to the buffer, returns false at the end """
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            self.eof = True
+            return False
+        
+        # Drop the text before the position that can still be seeked to
+        keep = self.pos if self.mark is None else min(self.pos, self.mark - self.offset)
+        self.buffer = self.buffer[keep:] + chunk
+        self.offset += keep
+        self.pos -= keep
+        return True
+    
+    def readline(self):
+        while True:
+            i = self.buffer.find('\n', self.pos)
+            if i >= 0:
+                line = self.buffer[self.pos:i + 1]
+                self.pos = i + 1
+                return line
+            if self.eof or not self._fill():
+                line = self.buffer[self.pos:]
+                self.pos = len(self.buffer)
+                return line
+            
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        self.mark = self.offset + self.pos
+        return self.mark
+    
+    def seek(self, offset):
+        if self.mark is None or offset < self.mark or offset > self.offset + len(self.buffer):
+            raise io.UnsupportedOperation('can only seek back to the position of the last tell()')
+        self.pos = offset - self.offset
+        return offset
+        
+    def close(self):
+        """ Stop the thread and close f """
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.f.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        
+        
+def open_pgn(fn):
+    """ 
+    Open the pgn file fn for reading, a .gz, .bz2 or .zst file is
+    decompressed as a stream by a ReadAheadReader
+    """
+    lower = fn.lower()
+    if lower.endswith('.gz'):
+        return ReadAheadReader(gzip.open(fn, 'rt'))
+    if lower.endswith('.bz2'):
+        return ReadAheadReader(bz2.open(fn, 'rt'))
+    if lower.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('the zstandard package is needed to read {}'.format(fn))
+        raw = zstandard.ZstdDecompressor().stream_reader(open(fn, 'rb'), closefd=True)
+        return ReadAheadReader(io.TextIOWrapper(raw))
+    return open(fn, 'r')
+
+
+class MultiGameReader:
+    """ 
+    Iterates over the (gcnt, game) items of the games in the pgn files, the
+    games are numbered through all files in their order
+    
+    The options are those of GameReader, first, last and skip are game
+    numbers through all files. source(gcnt) returns the file of a game.
+    """
+    
+    def __init__(self, files, game_filter=None, first=1, last=None, skip=None):
+        self.files = files
+        self.game_filter = game_filter
+        self.first = first
+        self.last = last
+        self.skip = skip
+        self.starts = []  # (number of the first game, file)
+        self.readers = []
+        
+    def __iter__(self):
+        base = 0
+        for fn in self.files:
+            if self.last is not None and base >= self.last:
+                break
+            self.starts.append((base + 1, fn))
+            with open_pgn(fn) as pgn:
+                reader = GameReader(pgn, self.game_filter, first=self.first,
+                                    last=self.last, skip=self.skip, base=base)
+                self.readers.append(reader)
+                yield from reader
+                base = reader.gcnt
+                
+    def source(self, gcnt):
+        """ Returns the file of game number gcnt """
+        i = bisect.bisect_right(self.starts, (gcnt, chr(0x10ffff))) - 1
+        return self.starts[i][1] if i >= 0 else None
+    
+    def stats(self):
+        """ Returns a one line summary of the reading speed of all files """
+        skimmed = sum(r.skimmed for r in self.readers)
+        skim_time = sum(r.skim_time for r in self.readers)
+        parsed = sum(r.parsed for r in self.readers)
+        parse_time = sum(r.parse_time for r in self.readers)
+        return 'pgn reader: {} files, skimmed {} games in {:.1f}s ({:.0f} games/s), parsed {} games in {:.1f}s ({:.0f} games/s)'.format(
+                len(self.starts), skimmed, skim_time, skimmed/skim_time if skim_time else 0.0,
+                parsed, parse_time, parsed/parse_time if parse_time else 0.0)
+
+
+async def open_engine(enginefn, hash_val, thread_val, weightsfile=None):
+    """ Start the analyzing engine and set its uci options, returns (engine, name) """
+    _, engine = await chess.engine.popen_uci(enginefn)
+    engname = engine.id['name']
+    
+    # Set Lc0 SmartPruningFactor to 0 to avoid analysis time pruning
+    if 'lc0' in engname.lower():
+        try:
+            await engine.configure({"SmartPruningFactor": 0})
+        except:
+            pass
+    else:
+        try:
+            await engine.configure({"Hash": hash_val})
+        except:
+            pass 
+        
+    try:
+        await engine.configure({"Threads": thread_val})
+    except:
+        pass
+    
+    # For NN engine that uses uci option WeightsFile similar to Lc0
+    if weightsfile is not None:
+        try:
+            await engine.configure({"WeightsFile": weightsfile})
+        except:
+            pass
+        
+    return engine, engname
+
+
+def start_engine(enginefn, hash_val, thread_val, weightsfile=None, watchdog=None):
+    """ 
+    Start the analyzing engine on the engine event loop, returns (engine, name)
+    
+    If watchdog, a dict of EngineSupervisor options, is not None the engine is
+    an EngineSupervisor
+    """
+    if watchdog is not None:
+        supervisor = EngineSupervisor(enginefn, hash_val, thread_val, weightsfile,
+                                      **watchdog)
+        return supervisor, supervisor.engname
+    return run_on_engine_loop(open_engine(enginefn, hash_val, thread_val, weightsfile))
+
+
+def stop_engine(engine):
+    """ Quit the engine started by start_engine() """
+    if isinstance(engine, EngineSupervisor):
+        engine.close()
+        return
+    run_on_engine_loop(engine.quit())
+
+
+class EngineSupervisor:
+    """ 
+    Watchdog of an analyzing engine, used in place of the engine by
+    start_search() and stop_engine()
+    
+    A search that does not finish within its time limit, or maxtime for a
+    depth or nodes limit, plus margin seconds, or that fails because the
+    engine died, kills the engine. It is started again with the same Hash,
+    Threads, WeightsFile and SmartPruningFactor options and the position is
+    searched again, up to retries times. A position that still fails is
+    appended to rejectfn and its search result is None.
+    """
+    
+    reject_lock = threading.Lock()
+    
+    def __init__(self, enginefn, hash_val, thread_val, weightsfile=None,
+                 margin=30.0, retries=2, rejectfn='reject.epd', maxtime=None,
+                 metrics=None):
+        self.enginefn = enginefn
+        self.hash_val = hash_val
+        self.thread_val = thread_val
+        self.weightsfile = weightsfile
+        self.margin = margin
+        self.retries = retries
+        self.rejectfn = rejectfn
+        self.maxtime = maxtime
+        self.metrics = metrics
+        self.restarts = 0
+        self.engine, self.engname = start_engine(enginefn, hash_val, thread_val,
+                                                 weightsfile)
+        
+    def start_search(self, board, limit, *args):
+        """ Start a search like start_search(), returns a SupervisedSearch """
+        search = SupervisedSearch(self, board.copy(), limit, args)
+        search.future = start_search(self.engine, board, limit, *args)
+        return search
+    
+    def wait(self, search):
+        """ Returns the result of search, it is started again after a failure """
+        seconds = search.limit.time if search.limit.time is not None else self.maxtime
+        timeout = seconds + self.margin if seconds is not None else None
+        for attempt in range(self.retries + 1):
+            if search.future is None:
+                search.future = start_search(self.engine, search.board, search.limit,
+                                             *search.args)
+            try:
+                return search.future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                reason = 'no result after {:.1f}s'.format(timeout)
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+                reason = 'engine error {}'.format(e or type(e).__name__)
+            logging.error('Search %s of %s failed, %s', attempt + 1, search.board.fen(), reason)
+            search.future.cancel()
+            search.future = None
+            self.restart()
+            
+        logging.error('Reject %s after %s failed searches', search.board.fen(), self.retries + 1)
+        with self.reject_lock:
+            append_to_file(self.rejectfn, '{}\n'.format(search.board.epd(
+                    c0='{}, {}'.format(self.engname, reason))))
+        return None
+        
+    def restart(self):
+        """ Kill the engine process and start it again with the same options """
+        engine = self.engine
+        
+        def kill():
+            try:
+                engine.transport.kill()
+            except Exception:
+                pass
+            
+        engine_loop().call_soon_threadsafe(kill)
+        self.engine, self.engname = start_engine(self.enginefn, self.hash_val,
+                                                 self.thread_val, self.weightsfile)
+        self.restarts += 1
+        if self.metrics is not None:
+            self.metrics.count('restarts')
+            
+    def close(self):
+        try:
+            stop_engine(self.engine)
+        except chess.engine.EngineTerminatedError:
+            pass
+        
+        
+class SupervisedSearch:
+    """ A search started by EngineSupervisor.start_search(), result() waits for it like a future """
+    
+    def __init__(self, supervisor, board, limit, args):
+        self.supervisor = supervisor
+        self.board = board
+        self.limit = limit
+        self.args = args
+        self.future = None
+        
+    def result(self):
+        return self.supervisor.wait(self)
+
+
+def analyze_games_parallel(games, numworkers, enginefn, hash_val, thread_val,
+                           analysis_start_move_num, outepdfn, dullfn,
+                           outpgnfn, analysis_options, writer, keep_order=False,
+                           checkpoint=None, screen_enginefn=None, watchdog=None):
+    """ 
+    Analyze the (gcnt, game) items of games with numworkers engines running
+    in parallel
+    
+    Games are read into a bounded queue and each worker thread, with its own
+    engine process, takes the next game from it. The output of a game is
+    collected by the worker and passed to the writer in one piece, so lines
+    of different games are never interleaved. If keep_order is true the writer
+    saves the games in the same order as in the pgn file. The checkpoint is
+    updated when the output of a game is saved. If watchdog is not None the
+    engines are supervised by an EngineSupervisor with these options.
+    """
+    game_queue = queue.Queue(maxsize=2*numworkers)
+    result_queue = queue.Queue()
+    
+    def worker():
+        engine, engname = start_engine(enginefn, hash_val, thread_val,
+                                       analysis_options['weightsfile'],
+                                       watchdog=watchdog)
+        screen_engine, screen_engname = None, None
+        if screen_enginefn is not None:
+            screen_engine, screen_engname = start_engine(screen_enginefn, hash_val, thread_val,
+                                                         watchdog=watchdog)
+        try:
+            while True:
+                item = game_queue.get()
+                if item is None:
+                    break
+                seq, gcnt, game = item
+                records = []
+                try:
+                    analyze_game(game, engine, enginefn, hash_val, thread_val,
+                                 analysis_start_move_num, outepdfn, gcnt,
+                                 engname, dullfn, outpgnfn,
+                                 emit=lambda fn, text: records.append((fn, text)),
+                                 resume_ply=checkpoint.plies.get(gcnt) if checkpoint else None,
+                                 done_plies=checkpoint.done.get(gcnt) if checkpoint else None,
+                                 screen_engine=screen_engine,
+                                 screen_engname=screen_engname,
+                                 **analysis_options)
+                except Exception as e:
+                    logging.error('Unexpected exception %s in analyzing game %s', e, gcnt)
+                result_queue.put((seq, gcnt, records))
+        finally:
+            stop_engine(engine)
+            if screen_engine is not None:
+                stop_engine(screen_engine)
+            
+    def save(gcnt, records):
+        writer.write_records(records)
+        if checkpoint is not None:
+            checkpoint.game_done(gcnt)
+            
+    def write_results():
+        pending = {}
+        next_seq = 0
+        while True:
+            item = result_queue.get()
+            if item is None:
+                break
+            seq, gcnt, records = item
+            if not keep_order:
+                save(gcnt, records)
+                continue
+            
+            # Hold the games that are done ahead of the ones still analyzed
+            pending[seq] = (gcnt, records)
+            while next_seq in pending:
+                save(*pending.pop(next_seq))
+                next_seq += 1
+                
+    workers = [threading.Thread(target=worker, name='worker{}'.format(i+1))
+               for i in range(numworkers)]
+    writer_thread = threading.Thread(target=write_results, name='writer')
+    for t in workers:
+        t.start()
+    writer_thread.start()
+    
+    for seq, (gcnt, game) in enumerate(games):
+        if checkpoint is not None:
+            checkpoint.game_started(gcnt)
+        game_queue.put((seq, gcnt, game))
+        
+    for _ in workers:
+        game_queue.put(None)
+    for t in workers:
+        t.join()
+        
+    result_queue.put(None)
+    writer_thread.join()
+
+
+def analyze_games(games, enginefn, hash_val, thread_val, weightsfile,
+                  start_move, outepdfn, dullfn, outpgnfn, analysis_options,
+                  writer, checkpoint=None, screen_enginefn=None, watchdog=None):
+    """ 
+    Analyze the (gcnt, game) items of games one after the other with a single
+    engine, the checkpoint is updated after each position. If watchdog is not
+    None the engine is supervised by an EngineSupervisor with these options.
+    """
+    # Define analyzing engine
+    engine, engname = start_engine(enginefn, hash_val, thread_val, weightsfile,
+                                   watchdog=watchdog)
+
+    # The engine of the screening search if it is not the analyzing engine
+    screen_engine, screen_engname = None, None
+    if screen_enginefn is not None:
+        screen_engine, screen_engname = start_engine(screen_enginefn, hash_val, thread_val,
+                                                     watchdog=watchdog)
+
+    # Analyze positions in the game
+    for gcnt, game in games:
+        if checkpoint is not None:
+            checkpoint.game_started(gcnt)
+        analyze_game(game,
+                     engine,
+                     enginefn,
+                     hash_val,
+                     thread_val,
+                     start_move,
+                     outepdfn,
+                     gcnt,
+                     engname,
+                     dullfn,
+                     outpgnfn,
+                     emit=writer.write,
+                     resume_ply=checkpoint.plies.get(gcnt) if checkpoint else None,
+                     done_plies=checkpoint.done.get(gcnt) if checkpoint else None,
+                     progress=checkpoint.position_done if checkpoint else None,
+                     screen_engine=screen_engine,
+                     screen_engname=screen_engname,
+                     **analysis_options)
+        if checkpoint is not None:
+            checkpoint.game_done(gcnt)
+
+    stop_engine(engine)
+    if screen_engine is not None:
+        stop_engine(screen_engine)
+
+
+# Weights of the signals of position_priority()
+PRIORITY_WEIGHTS = {'winner': 3.0, 'draw': 1.0, 'capture': 2.0, 'check': 2.0,
+                    'pin': 1.0, 'material': 2.0, 'move': 1.0, 'eval': 4.0}
+
+
+def position_priority(plan, ply, result, minbs1th3):
+    """ 
+    Returns the priority of the position at ply of plan from signals that
+    need no engine, higher is searched first
+    
+    The signals are: the side to move won the game, or the game is a draw,
+    the game move is a capture or gives check, a piece of the side not to
+    move is pinned, the material and the move number. If the plan has the
+    evals of the pgn, the eval for the side to move relative to minbs1th3
+    is added too.
+    """
+    w = PRIORITY_WEIGHTS
+    board = plan.boards[ply]
+    move = plan.move_at(ply)
+    winner = {'1-0': chess.WHITE, '0-1': chess.BLACK}.get(result)
+    priority = w['material']*plan.material_at(ply)/62 \
+        + w['move']*min(board.fullmove_number, 60)/60
+    if winner is not None and winner == board.turn:
+        priority += w['winner']
+    elif result == '1/2-1/2':
+        priority += w['draw']
+    if plan.capture[ply - plan.first_ply]:
+        priority += w['capture']
+    if board.gives_check(move):
+        priority += w['check']
+    if abs_pinned(board, not board.turn):
+        priority += w['pin']
+    before, _ = plan.evals_at(ply)
+    if before is not None:
+        stm_eval = before if board.turn == chess.WHITE else -before
+        priority += w['eval']*max(-1.0, min(1.0, stm_eval/max(1, minbs1th3)))
+    return priority
+
+
+class PositionPlan(GamePlan):
+    """ 
+    GamePlan of a single position of a game, made again from the compact
+    record of the position that a BudgetScheduler keeps
+    
+    record is (fen, last move, game move, material, capture, eval before,
+    eval after), fen is the position before the last move, the move that
+    led to the position, if there is one. The board of the position has
+    this move on its stack like the boards of GamePlan.
+    """
+    
+    def __init__(self, record):
+        fen, last, move, material, capture, before, after = record
+        board = chess.Board(fen)
+        if last is not None:
+            board.push_uci(last)
+        self.first_ply = board.ply()
+        self.moves = [chess.Move.from_uci(move)]
+        self.material = [material]
+        self.check = [board.is_check()]
+        self.capture = [capture]
+        self.in_window = [True]
+        self.reasons = [None]
+        self.evals = [after]
+        self.before = before
+        self.boards = {self.first_ply: board}
+        self.visited = 1
+        self.skipped = []
+        self.eligible = [self.first_ply]
+        self.cut = None
+        
+    @staticmethod
+    def record(plan, ply):
+        """ Returns the compact record of the position at ply of plan, a GamePlan """
+        board = plan.boards[ply]
+        last = board.move_stack[-1].uci() if board.move_stack else None
+        before, after = plan.evals_at(ply)
+        return (board.root().fen(), last, plan.move_at(ply).uci(),
+                plan.material_at(ply), plan.capture[ply - plan.first_ply],
+                before, after)
+        
+    def evals_at(self, ply):
+        return self.before, self.evals[0]
+
+
+class BudgetScheduler:
+    """ 
+    Best-first queue of the positions of all games of a --budget run
+    
+    The positions are searched in the order of position_priority() until
+    budget seconds have passed since the scheduler was made, a search that
+    is running then is finished. Every sample-th search is instead a
+    position of a uniform random sample of all positions, which are not in
+    the queue, its yield estimates the yield of searching the games in the
+    order of the pgn file.
+    
+    Only the compact record of PositionPlan is kept per position and the
+    headers per game, the boards are made again when a position is taken.
+    """
+    
+    def __init__(self, budget, minbs1th3, sample=0, seed=0):
+        self.deadline = time.monotonic() + budget
+        self.minbs1th3 = minbs1th3
+        self.sample = sample
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.heap = []
+        self.samples = []
+        self.games = {}  # gcnt: [game with the headers only, positions not done]
+        self.added = 0
+        self.taken = 0
+        self.prefiltered = {}
+        self.counts = {'best': [0, 0, 0.0], 'sample': [0, 0, 0.0]}  # positions, interesting, seconds
+        
+    def add(self, gcnt, game, plan):
+        """ Add the eligible positions of plan, the GamePlan of game gcnt """
+        result = game.headers.get('Result')
+        entries = [(position_priority(plan, ply, result, self.minbs1th3), ply,
+                    PositionPlan.record(plan, ply))
+                   for ply in plan.eligible]
+        with self.lock:
+            for reason, count in plan.skip_counts().items():
+                self.prefiltered[reason] = self.prefiltered.get(reason, 0) + count
+            if entries:
+                self.games[gcnt] = [chess.pgn.Game(game.headers), len(entries)]
+            for priority, ply, record in entries:
+                self.added += 1
+                if self.sample and self.rng.randrange(self.sample) == 0:
+                    self.samples.append((gcnt, ply, record))
+                    continue
+                heapq.heappush(self.heap, (-priority, self.added, gcnt, ply, record))
+                
+    def next(self):
+        """ 
+        Returns (kind, gcnt, game, plan, ply) of the next position to
+        search, kind is best or sample and plan its PositionPlan, or None if
+        the budget is spent or all positions are done
+        """
+        with self.lock:
+            if time.monotonic() >= self.deadline or not (self.heap or self.samples):
+                return None
+            self.taken += 1
+            if self.samples and (self.taken % self.sample == 0 or not self.heap):
+                kind = 'sample'
+                gcnt, ply, record = self.samples.pop(self.rng.randrange(len(self.samples)))
+            else:
+                kind = 'best'
+                _, _, gcnt, ply, record = heapq.heappop(self.heap)
+            game = self.games[gcnt][0]
+        return kind, gcnt, game, PositionPlan(record), ply
+        
+    def done(self, kind, gcnt, interesting, seconds):
+        """ Record a searched position of game gcnt, the games with no positions left are freed """
+        with self.lock:
+            counts = self.counts[kind]
+            counts[0] += 1
+            counts[1] += interesting
+            counts[2] += seconds
+            entry = self.games[gcnt]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.games[gcnt]
+                
+    def stats(self):
+        """ Returns a one line summary of the yield of the best-first and the sampled searches """
+        def rate(counts):
+            return counts[1]/(counts[2]/3600) if counts[2] else 0.0
+        best, sample = self.counts['best'], self.counts['sample']
+        text = 'budget: {} of {} positions searched, best-first {} interesting of {} positions in {:.1f} engine-seconds ({:.1f}/engine-hour)'.format(
+                best[0] + sample[0], self.added, best[1], best[0], best[2], rate(best))
+        if sample[0]:
+            text += ', uniform sample {} interesting of {} positions ({:.1f}/engine-hour)'.format(
+                    sample[1], sample[0], rate(sample))
+            if sample[1]:
+                text += ', best-first is {:.2f}x the pgn order'.format(rate(best)/rate(sample))
+        if self.prefiltered:
+            text += ', not queued: {}'.format(', '.join('{} {}'.format(k, v)
+                                                        for k, v in sorted(self.prefiltered.items())))
+        return text
+
+
+def analyze_budget(games, numworkers, enginefn, hash_val, thread_val,
+                   start_move, outepdfn, dullfn, outpgnfn, analysis_options,
+                   writer, scheduler, screen_enginefn=None, watchdog=None):
+    """ 
+    Plan all (gcnt, game) items of games, then analyze their positions in
+    the order of scheduler with numworkers engines until its budget is
+    spent. The output of every position goes to the writer right away.
+    
+    A position is counted in the metrics only when it is taken from the
+    scheduler, the positions that the prefilter skips are counted in the
+    stats() of the scheduler.
+    """
+    metrics = analysis_options.get('metrics')
+    for gcnt, game in games:
+        if metrics is not None:
+            metrics.count('games')
+        t0 = time.perf_counter()
+        plan = GamePlan(game, start_move, analysis_options.get('minpiecevalue', 0),
+                        analysis_options.get('maxpiecevalue', 62),
+                        analysis_options.get('pin', False),
+                        evals=analysis_options.get('pgn_eval') is not None,
+                        eval_depth=getattr(analysis_options.get('pgn_eval'), 'depth', 0))
+        scheduler.add(gcnt, game, plan)
+        if metrics is not None:
+            metrics.observe('plan', time.perf_counter() - t0)
+    logging.info('budget: %s positions to search', scheduler.added)
+    
+    options = dict(analysis_options, progress_interval=float('inf'))
+    progress_interval = analysis_options.get('progress_interval', 0.5)
+    last_progress = [0.0]
+    
+    def worker():
+        engine, engname = start_engine(enginefn, hash_val, thread_val,
+                                       analysis_options['weightsfile'],
+                                       watchdog=watchdog)
+        screen_engine, screen_engname = None, None
+        if screen_enginefn is not None:
+            screen_engine, screen_engname = start_engine(screen_enginefn, hash_val, thread_val,
+                                                         watchdog=watchdog)
+        saved = [0]
+        
+        def emit(fn, text):
+            if fn == outepdfn:
+                saved[0] += 1
+            writer.write(fn, text)
+            
+        try:
+            while True:
+                item = scheduler.next()
+                if item is None:
+                    break
+                kind, gcnt, game, plan, ply = item
+                if metrics is not None:
+                    metrics.count('positions')
+                saved[0] = 0
+                t0 = time.perf_counter()
+                try:
+                    analyze_game(game, engine, enginefn, hash_val, thread_val,
+                                 start_move, outepdfn, gcnt, engname, dullfn,
+                                 outpgnfn, emit=emit, screen_engine=screen_engine,
+                                 screen_engname=screen_engname, plan=plan,
+                                 plies=[ply], **options)
+                except Exception as e:
+                    logging.error('Unexpected exception %s in analyzing game %s', e, gcnt)
+                scheduler.done(kind, gcnt, saved[0], time.perf_counter() - t0)
+                
+                now = time.monotonic()
+                if now - last_progress[0] >= progress_interval:
+                    last_progress[0] = now
+                    print('budget: {} positions, {:.0f}s left \r'.format(
+                            scheduler.taken, max(0.0, scheduler.deadline - now)), end='')
+        finally:
+            stop_engine(engine)
+            if screen_engine is not None:
+                stop_engine(screen_engine)
+                
+    workers = [threading.Thread(target=worker, name='worker{}'.format(i+1))
+               for i in range(numworkers)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+
+def parse_address(text):
+    """ 
+    Returns (family, address) of a coordinator address, unix:path is a unix
+    socket and host:port a tcp socket
+    """
+    if text.startswith('unix:'):
+        return socket.AF_UNIX, text[len('unix:'):]
+    host, _, port = text.rpartition(':')
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+
+def game_units(pgnfn, offsets, unit_size, first=1, last=None):
+    """ 
+    Split the games first to last of pgnfn into units of unit_size games,
+    returns a list of (first, last, start offset, end offset)
+    """
+    size = os.path.getsize(pgnfn)
+    last = len(offsets) if last is None else min(last, len(offsets))
+    units = []
+    for g in range(first, last + 1, unit_size):
+        g_last = min(g + unit_size - 1, last)
+        end = offsets[g_last] if g_last < len(offsets) else size
+        units.append((g, g_last, offsets[g - 1], end))
+    return units
+
+
+class Coordinator:
+    """ 
+    Hands out units of games to the workers and saves their results
+    
+    A unit is leased to one worker for lease seconds, the worker renews the
+    lease while it analyzes the games. A unit whose lease expired or whose
+    worker disconnected goes back to the pending units and is given to the
+    next worker that asks. Only the first result of a unit is saved, so a
+    unit that was reassigned is not saved twice.
+    """
+    
+    def __init__(self, pgnfn, units, writer, kinds, job, lease=60.0,
+                 checkpoint=None):
+        self.pgnfn = pgnfn
+        self.units = units
+        self.writer = writer
+        self.kinds = kinds
+        self.job = job
+        self.lease = lease
+        self.checkpoint = checkpoint
+        self.lock = threading.Lock()
+        self.pending = list(range(len(units)))
+        self.leases = {}  # unit: (deadline, client)
+        self.started = set()
+        self.done = set()
+        self.reassigned = 0
+        self.finished = threading.Event()
+        if not units:
+            self.finished.set()
+        
+    def _expire(self):
+        now = time.monotonic()
+        for unit, (deadline, client) in list(self.leases.items()):
+            if deadline < now:
+                logging.warning('Lease of unit %s by %s expired, reassign it', unit, client)
+                del self.leases[unit]
+                self.pending.insert(0, unit)
+                self.reassigned += 1
+                
+    def get(self, client):
+        """ Returns the next unit message for client """
+        with self.lock:
+            self._expire()
+            if self.finished.is_set():
+                return {'op': 'done'}
+            if not self.pending:
+                return {'op': 'wait', 'seconds': min(self.lease/4, 5.0)}
+            unit = self.pending.pop(0)
+            self.leases[unit] = (time.monotonic() + self.lease, client)
+            first, last, start, end = self.units[unit]
+            if self.checkpoint is not None and unit not in self.started:
+                for gcnt in range(first, last + 1):
+                    self.checkpoint.game_started(gcnt)
+            self.started.add(unit)
+        with open(self.pgnfn, 'rb') as f:
+            f.seek(start)
+            text = f.read(end - start).decode('utf-8', errors='replace')
+        logging.info('Unit %s (games %s to %s) is leased to %s', unit, first, last, client)
+        return dict(self.job, op='unit', unit=unit, first=first, pgn=text, lease=self.lease)
+    
+    def renew(self, client, unit):
+        """ Extend the lease of unit, returns false if client lost it """
+        with self.lock:
+            lease = self.leases.get(unit)
+            if lease is None or lease[1] != client:
+                return False
+            self.leases[unit] = (time.monotonic() + self.lease, client)
+            return True
+        
+    def result(self, client, unit, records):
+        """ Save the records of unit, returns false if it was already saved """
+        with self.lock:
+            if unit in self.done:
+                return False
+            self.done.add(unit)
+            self.leases.pop(unit, None)
+            if unit in self.pending:
+                self.pending.remove(unit)
+            self.writer.write_records([(self.kinds[kind], text) for kind, text in records])
+            if self.checkpoint is not None:
+                first, last, _, _ = self.units[unit]
+                for gcnt in range(first, last + 1):
+                    self.checkpoint.game_done(gcnt)
+            if len(self.done) == len(self.units):
+                self.finished.set()
+        logging.info('Unit %s is done by %s', unit, client)
+        return True
+    
+    def release(self, client):
+        """ The client disconnected, its units go back to the pending units """
+        with self.lock:
+            for unit, (deadline, owner) in list(self.leases.items()):
+                if owner == client:
+                    logging.warning('Worker %s disconnected, reassign unit %s', client, unit)
+                    del self.leases[unit]
+                    self.pending.insert(0, unit)
+                    self.reassigned += 1
+                    
+    def stats(self):
+        """ Returns a one line summary of the units """
+        return 'coordinator: {} of {} units done, {} reassigned'.format(
+                len(self.done), len(self.units), self.reassigned)
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    """ Answers the json line requests of one worker connection """
+    
+    def handle(self):
+        coordinator = self.server.coordinator
+        client = '{}#{}'.format(self.client_address or 'local', id(self))
+        try:
+            for line in self.rfile:
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'get':
+                    reply = coordinator.get(client)
+                elif op == 'renew':
+                    reply = {'op': 'ok' if coordinator.renew(client, request['unit']) else 'lost'}
+                elif op == 'result':
+                    accepted = coordinator.result(client, request['unit'], request['records'])
+                    reply = {'op': 'ok', 'accepted': accepted}
+                else:
+                    reply = {'op': 'error', 'error': 'unknown op {}'.format(op)}
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+        except (OSError, ValueError) as e:
+            logging.warning('Connection of worker %s failed: %s', client, e)
+        finally:
+            coordinator.release(client)
+
+
+class CoordinatorTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class CoordinatorUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        
+        
+def run_coordinator(address, coordinator):
+    """ Serve the units of coordinator on address until all are done """
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = CoordinatorUnixServer(addr, CoordinatorHandler)
+    else:
+        server = CoordinatorTCPServer(addr, CoordinatorHandler)
+    server.coordinator = coordinator
+    thread = threading.Thread(target=server.serve_forever, name='coordinator', daemon=True)
+    thread.start()
+    logging.info('Coordinator is serving %s units on %s', len(coordinator.units), address)
+    print('coordinator: serving {} units on {}'.format(len(coordinator.units), address))
+    try:
+        coordinator.finished.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+        
+
+class WorkerConnection:
+    """ A connection to the coordinator, a request waits for its reply """
+    
+    def __init__(self, address):
+        family, addr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.rfile = self.sock.makefile('rb')
+        self.lock = threading.Lock()
+        
+    def request(self, message):
+        with self.lock:
+            self.sock.sendall((json.dumps(message) + '\n').encode())
+            line = self.rfile.readline()
+        if not line:
+            raise ConnectionError('the coordinator closed the connection')
+        return json.loads(line)
+    
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+        
+
+def run_worker(address, enginefn, hash_val, thread_val, weightsfile,
+               local_options=None, watchdog=None, screen_enginefn=None):
+    """ 
+    Analyze the units of the coordinator at address until it has no more,
+    with one engine. The lease of a unit is renewed by a heartbeat thread
+    while its games are analyzed. local_options are passed to analyze_game
+    besides the options of the coordinator, for example the cache, watchdog
+    the options of the EngineSupervisor of the engine if not None. If the
+    coordinator screens the positions, the screening search runs on the
+    engine screen_enginefn, or on the analyzing engine if it is None.
+    """
+    conn = WorkerConnection(address)
+    engine, engname = start_engine(enginefn, hash_val, thread_val, weightsfile,
+                                   watchdog=watchdog)
+    screen_engine, screen_engname = None, None
+    cascade = None
+    units = 0
+    try:
+        while True:
+            try:
+                message = conn.request({'op': 'get'})
+            except (OSError, ConnectionError):
+                logging.info('The coordinator is gone, the worker stops')
+                break
+            if message['op'] == 'done':
+                break
+            if message['op'] == 'wait':
+                time.sleep(message['seconds'])
+                continue
+            
+            unit = message['unit']
+            screen = message.get('screen')
+            if screen is not None and cascade is None:
+                options = message['options']
+                cascade = ScreeningCascade(chess.engine.Limit(time=screen['time'],
+                                                              depth=screen['depth'],
+                                                              nodes=screen['nodes']),
+                                           screen['margin'],
+                                           *[options[name] for name in THRESHOLDS],
+                                           positional=options['positional'],
+                                           sample=screen['sample'])
+                if screen_enginefn is not None:
+                    screen_engine, screen_engname = start_engine(screen_enginefn, hash_val,
+                                                                 thread_val, watchdog=watchdog)
+            stop_heartbeat = threading.Event()
+            
+            def heartbeat():
+                while not stop_heartbeat.wait(message['lease']/3):
+                    try:
+                        if conn.request({'op': 'renew', 'unit': unit})['op'] == 'lost':
+                            logging.warning('Lease of unit %s was lost', unit)
+                    except (OSError, ConnectionError):
+                        return
+                
+            thread = threading.Thread(target=heartbeat, name='heartbeat', daemon=True)
+            thread.start()
             
-    return pcvalue  
+            records = []
+            try:
+                reader = GameReader(io.StringIO(message['pgn']),
+                                    GameFilter(**message['filter']))
+                for gcnt, game in reader:
+                    analyze_game(game, engine, enginefn, hash_val, thread_val,
+                                 message['start_move'], 'interesting',
+                                 message['first'] + gcnt - 1, engname, 'dull',
+                                 'pgn',
+                                 emit=lambda kind, text: records.append((kind, text)),
+                                 cascade=cascade if screen is not None else None,
+                                 screen_engine=screen_engine,
+                                 screen_engname=screen_engname,
+                                 **dict(message['options'], weightsfile=weightsfile,
+                                        **(local_options or {})))
+            finally:
+                stop_heartbeat.set()
+                thread.join()
+            try:
+                conn.request({'op': 'result', 'unit': unit, 'records': records})
+            except (OSError, ConnectionError):
+                logging.warning('The coordinator is gone, the result of unit %s is lost', unit)
+                break
+            units += 1
+    finally:
+        stop_engine(engine)
+        if screen_engine is not None:
+            stop_engine(screen_engine)
+        conn.close()
+    if cascade is not None:
+        logging.info(cascade.stats())
+    return units
 
 
-def interesting_pos(board, bs1, bs2, minbs1th1, minbs1th2, minbs1th3,
-                   maxbs2th1, maxbs2th2, maxbs2th3):
+def analyze_fen(fen, engine, engname, options):
     """ 
-    board: board position
-    bs1: bestscore1 from multipv 1
-    bs2: bestscore2 from multipv 2
-    
-    minbs1th1: minimum best score 1 threshold 1
-    minbs1th2: minimum best score 1 threshold 2
-    minbs1th3: minimum best score 1 threshold 3
-    
-    minbs1th1 > minbs1th2 > minbs1th3
-    
-    maxbs2th1: maximum best score 2 threshold 1
-    maxbs2th2: maximum best score 2 threshold 2
-    maxbs2th3: maximum best score 2 threshold 3
-    
-    maxbs2th1 > maxbs2th2 > maxbs2th3
+    Search and classify the position fen like a position of a game
     
+    options are the analyze_game options. Returns (verdict, epd, reason),
+    verdict is interesting or dull, or None if the position is not saved and
+    reason tells why.
     """
-    logging.info('bestscore1: {}, bestscore2: {}'.format(bs1, bs2))
-    if bs1 >= minbs1th1:
-        # mate score
-        if bs1 >= 30000 and bs2 <= min(2000, 2*maxbs2th1):
-            return True
-        if bs2 <= maxbs2th1:
-            return True
-    elif bs1 >= minbs1th2:
-        if bs2 <= maxbs2th2:
-            return True
-    elif bs1 >= minbs1th3:
-        if bs2 <= maxbs2th3:
-            return True
+    board = chess.Board(fen)
+    metrics = options.get('metrics')
+    if metrics is not None:
+        metrics.count('positions')
+        
+    reason, _ = prefilter(board, options['minpiecevalue'], options['maxpiecevalue'],
+                          options['pin'])
+    known = options.get('known')
+    if reason is None and known is not None \
+            and known.skip(chess.polyglot.zobrist_hash(board)):
+        reason = 'known'
+    if reason is not None:
+        if metrics is not None:
+            metrics.count('skips', reason)
+        return None, None, reason
     
-    logging.info('Not an interesting pos: {}'.format(board.fen()))
+    limit = chess.engine.Limit(time=options['maxtime'])
+    cache = options.get('cache')
+    result = None
+    if cache is not None:
+        exits = exit_key(options['minbs1th3'], options['minscorediffcheck'],
+                         options.get('stop_policy'))
+        result = cache.get(board, engname, limit, options['mintime'], exits)
+    if result is None:
+        t0 = time.perf_counter()
+        result = search_position(engine, board, limit, options['mintime'],
+                                 options['minbs1th3'], options['minscorediffcheck'],
+                                 policy=options.get('stop_policy'))
+        if result is None:
+            return None, None, 'reject'
+        if metrics is not None:
+            metrics.count('searches', 'engine')
+            metrics.search_done(result, limit, time.perf_counter() - t0)
+        if cache is not None:
+            cache.put(board, engname, limit, result, exits)
+    if result['bs2'] is None and result['bs1'] is not None \
+            and result['bs1'] < options['minbs1th3']:
+        if metrics is not None:
+            metrics.count('skips', 'bs1')
+        return None, None, 'thresholds'
+    if result['bs1'] is None or result['bs2'] is None:
+        return None, None, 'nobs2'
     
-    return False
+    verdict = classify_position(board, result['bs1'], result['bs2'], result['bm1'],
+                                result['complexity'],
+                                *[options[name] for name in THRESHOLDS],
+                                positional=options['positional'],
+                                disable_complexity=options['disable_complexity'],
+                                metrics=metrics)
+    if verdict is None:
+        return None, None, 'thresholds'
+    if metrics is not None:
+        metrics.count('verdicts', verdict)
+    return verdict, position_epd(board, result, engname), None
 
 
-def positional_pos(board, bs1, bs2, minbs1th1, minbs1th2, minbs1th3,
-                   maxbs2th1, maxbs2th2, maxbs2th3):
+class AnalysisServer:
     """ 
-    * The engine bestscore1 is not winning and bestscore2 is not lossing
-    * The score gap between bestscore1 and bestcore2 is  generally smaller    
+    Pool of warm engines that analyze the pgn and fen jobs of requests
+    
+    A request takes an idle engine from the pool, or waits for one, and
+    puts it back when its job is done. The requests that wait are the queue
+    depth. The latency of every request is kept in the metrics, and of the
+    last ones for the percentiles of stats().
     """
-    if bs1 >= minbs1th1 and bs1 <= minbs1th1 + 50:
-        if bs2 <= maxbs2th1 and bs2 >= maxbs2th1 - 25:
-            return True
-    if bs1 >= minbs1th2 and bs1 <= minbs1th1:
-        if bs2 <= maxbs2th2 and bs2 >= maxbs2th2 - 25:
-            return True
-    if bs1 >= minbs1th3 and bs1 <= minbs1th2:
-        if bs2 <= maxbs2th3 and bs2 >= maxbs2th3 - 25:
-            return True
     
-    logging.info('Not positional: {}'.format(board.fen()))
+    def __init__(self, engines, enginefn, hash_val, thread_val, start_move,
+                 options, filter_options, metrics):
+        self.pool = queue.Queue()
+        for engine in engines:
+            self.pool.put(engine)
+        self.size = len(engines)
+        self.enginefn = enginefn
+        self.hash_val = hash_val
+        self.thread_val = thread_val
+        self.start_move = start_move
+        self.options = options
+        self.filter_options = filter_options
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.active = 0
+        self.latencies = collections.deque(maxlen=1000)
+        
+    def analyze(self, job):
+        """ 
+        Analyze the games of job['pgn'] and the positions of job['fen'] and
+        job['fens'], returns a dict with the saved positions of the games,
+        the verdicts of the fen positions and the times of the request
+        """
+        t0 = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+        engine, engname = self.pool.get()
+        with self.lock:
+            self.waiting -= 1
+            self.active += 1
+        queue_seconds = time.perf_counter() - t0
+        try:
+            positions = []
+            if job.get('pgn'):
+                records = []
+                reader = GameReader(io.StringIO(job['pgn']), GameFilter(**self.filter_options))
+                for gcnt, game in reader:
+                    analyze_game(game, engine, self.enginefn, self.hash_val,
+                                 self.thread_val, self.start_move, 'interesting',
+                                 gcnt, engname, 'dull', 'pgn',
+                                 emit=lambda kind, text, gcnt=gcnt: records.append((gcnt, kind, text)),
+                                 **self.options)
+                positions += [self.record(kind, text, game=gcnt)
+                              for gcnt, kind, text in records if kind != 'pgn']
+            fens = ([job['fen']] if job.get('fen') else []) + list(job.get('fens', []))
+            for fen in fens:
+                verdict, epd, reason = analyze_fen(fen, engine, engname, self.options)
+                if verdict is None:
+                    positions.append({'verdict': None, 'fen': fen, 'reason': reason})
+                else:
+                    positions.append(self.record(verdict, epd))
+        finally:
+            self.pool.put((engine, engname))
+            seconds = time.perf_counter() - t0
+            with self.lock:
+                self.active -= 1
+                self.latencies.append(seconds)
+            self.metrics.observe('request', seconds)
+        return {'positions': positions, 'seconds': seconds, 'queue_seconds': queue_seconds}
     
-    return False
-
-
-def abs_pinned(board, color):
-    """ Returns true if one or more pieces of color color is pinned """
-    for sq in chess.SQUARES:
-        if board.is_pinned(color, sq) \
-            and board.piece_at(sq) != chess.Piece(chess.PAWN, color):
-            logging.info('piece at square {} ({}) is pinned'.format(sq, board.piece_at(sq)))
-            logging.debug('\n{}'.format(board))
-            squares = chess.SquareSet([sq])
-            logging.debug('\n{}'.format(squares))
-            return True
+    @staticmethod
+    def record(verdict, epd, game=None):
+        """ Returns the dict of a saved position with the opcodes of its epd """
+        board, operations = chess.Board.from_epd(epd)
+        record = {'verdict': verdict, 'fen': board.fen(),
+                  'bm': board.san(operations['bm'][0]), 'ce': operations['ce']}
+        for opcode in ('c1', 'c2', 'c3'):
+            record[opcode] = operations.get(opcode)
+        if game is not None:
+            record['game'] = game
+        record['epd'] = epd.rstrip('\n')
+        return record
     
-    return False 
-
-
-def analyze_game(game, engine, enginefn, hash_val, thread_val,
-                 analysis_start_move_num, outepdfn, gcnt, engname,
-                 dullfn, outpgnfn,
-                 mintime=5.0, maxtime=15.0, minscorediffcheck=25,
-                 minbs1th1=2000, minbs1th2=1000, minbs1th3=500,
-                 maxbs2th1=300, maxbs2th2=200, maxbs2th3=100,
-                 weightsfile=None, skipdraw=False, pin=False,
-                 positional=False, minpiecevalue=0, maxpiecevalue=62,
-                 disable_complexity=False, save_last_move=False):
-    """ Analyze positons in the game and save interesting and dull positions to a file """
-
-    limit = chess.engine.Limit(time=maxtime)
+    def stats(self):
+        """ Returns the engines, queue depth, request latencies and counters as a dict """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            waiting, active = self.waiting, self.active
+        latency = {'count': len(latencies)}
+        if latencies:
+            latency['mean'] = sum(latencies)/len(latencies)
+            for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                latency[name] = latencies[min(int(q*len(latencies)), len(latencies) - 1)]
+            latency['max'] = latencies[-1]
+        return {'engines': self.size, 'idle_engines': self.pool.qsize(),
+                'active_requests': active, 'queue_depth': waiting,
+                'latency': latency, 'counters': self.metrics.snapshot()['counters']}
     
-    # Copy orig game header to our epd output
-    ev = game.headers['Event']
-    si = game.headers['Site']
-    da = game.headers['Date']
-    ro = game.headers['Round']
-    wp = game.headers['White']
-    bp = game.headers['Black']
-    res = game.headers['Result']
+    def prometheus(self):
+        """ Returns the metrics and the gauges of the pool in the Prometheus text format """
+        stats = self.stats()
+        lines = [self.metrics.prometheus().rstrip('\n')]
+        for name, text in (('queue_depth', 'Requests waiting for an engine'),
+                           ('active_requests', 'Requests being analyzed'),
+                           ('idle_engines', 'Engines waiting for a request')):
+            metric = 'chiller_server_{}'.format(name)
+            lines.append('# HELP {} {}'.format(metric, text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{} {}'.format(metric, stats[name]))
+        return '\n'.join(lines) + '\n'
     
-    # If result of this game is a draw and skipdraw is true, we skip it
-    if skipdraw and res == '1/2-1/2':
-        return
     
-    c0_val = wp + ' - ' + bp + ', ' + ev + ', ' + si + ', ' + da + ', R' + ro 
+class AnalysisHandler(http.server.BaseHTTPRequestHandler):
+    """ 
+    POST /analyze with a json job like {"pgn": "..."}, {"fen": "..."} or
+    {"fens": [...]}, GET /stats for json stats and GET /metrics for the
+    Prometheus metrics
+    """
     
-    poscnt = 0   
+    protocol_version = 'HTTP/1.1'
     
-    # Parse move in reverse
-    game_end = game.end()
-    curboard = game_end.board()
+    def address_string(self):
+        # The client address of a unix socket is not a (host, port)
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
     
-    while curboard:
-        board = curboard        
-        fmvn = board.fullmove_number
-        
-        if fmvn < analysis_start_move_num:
-            logging.warning('move start limit is reached, exit from this game')
-            break
-        
-        g_move = board.pop()
-        curboard = board
-        fen = curboard.fen()
-        
-        # Print the fen before g_move is made on the board
-        poscnt += 1  
+    def log_message(self, format, *args):
+        logging.info('%s %s', self.address_string(), format % args)
         
-        print('game {} / position {} \r'.format(gcnt, poscnt), end='')
+    def reply(self, code, text, content_type='application/json'):
+        data = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
         
-        logging.info('game {} / position {}'.format(gcnt, poscnt))
-        logging.info('{}'.format(board.fen()))
-        logging.info('game move: {}'.format(curboard.san(g_move)))
+    def error(self, code, message):
+        self.server.analysis.metrics.count('requests', str(code))
+        self.reply(code, json.dumps({'error': message}))
         
-        # piece value conditions
-        pcval = piece_value(curboard)
-        if pcval < minpiecevalue:
-            logging.warning('Skip this pos piece value {} is below minimmum of {}'.format(pcval, minpiecevalue))
-            continue
-        
-        if pcval > maxpiecevalue:
-            logging.warning('Skip this pos and game piece value {} is above maximum of {}'.format(pcval, maxpiecevalue))
-            break
-        
-        # Skip this position if --pin is set and no one of the not stm piece is pinned
-        if pin and not abs_pinned(board, board.turn ^ 1):
-            logging.warning('Skip this pos no piece of not stm is pinned')
-            continue
+    def do_GET(self):
+        analysis = self.server.analysis
+        if self.path == '/stats':
+            self.reply(200, json.dumps(analysis.stats()))
+        elif self.path == '/metrics':
+            self.reply(200, analysis.prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self.error(404, 'unknown path {}'.format(self.path))
+            
+    def do_POST(self):
+        if self.path != '/analyze':
+            self.error(404, 'unknown path {}'.format(self.path))
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as e:
+            self.error(400, 'the job is not json: {}'.format(e))
+            return
+        if not isinstance(job, dict) or not any(job.get(k) for k in ('pgn', 'fen', 'fens')):
+            self.error(400, 'the job has no pgn, fen or fens')
+            return
+        try:
+            result = self.server.analysis.analyze(job)
+        except ValueError as e:
+            self.error(400, str(e))
+            return
+        except Exception as e:
+            logging.error('Unexpected exception %s in request %s', e, job)
+            self.error(500, str(e))
+            return
+        self.server.analysis.metrics.count('requests', '200')
+        self.reply(200, json.dumps(result))
         
-        # If side to move is in check, skip this position
-        if board.is_check():
-            logging.warning('Skip this pos, stm is in check')
-            continue
         
-        # Run engine in multipv 2
-        logging.info('{} is searching at multipv {} for {}s ...'.format(
-                engname, 2, maxtime))
+class AnalysisTCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class AnalysisUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
         
-        bm1, bm2, depth = None, None, None
-        raw_pv = None
-        bestmovechanges = 0  # Start comparing bestmove1 at depth 4
-        tmpmove, oldtmpmove = None, None
         
-        # Run engine at multipv 2        
-        with engine.analysis(board, limit, multipv=2) as analysis:
-            for info in analysis:
-                time.sleep(0.01)
-                try:
-                    multipv = info['multipv']
-                    depth = info['depth']
-                    if info['score'].is_mate():
-                        s = info['score'].relative.score(mate_score=32000)
-                    else:
-                        s = info['score'].relative.score()
-                    pv = info['pv'][0:5]
-                    t = info['time']
-                
-                    if multipv == 1:
-                        bm1 = pv[0]
-                        bs1 = s
-                        raw_pv = pv
-                        
-                        # Exit early if score is below half of minbest1score3
-                        if t >= mintime and bs1 < minbs1th3/2:
-                            logging.warning('Exit search early, current best score is only {}'.format(bs1))
-                            break
-                        
-                        # Record bestmove move changes to determine position complexity
-                        if 'depth' in info and 'pv' in info \
-                                and 'score' in info \
-                                and not 'lowerbound' in info \
-                                and not 'upperbound' in info \
-                                and depth >= 4:
-                            tmpmove = info['pv'][0]
-                            if oldtmpmove is not None and tmpmove != oldtmpmove:
-                                bestmovechanges += 1
-                            
-                    elif multipv == 2:
-                        bm2 = pv[0]
-                        bs2 = s
-                        
-                    # Save analysis time by exiting it if score difference
-                    # between bestscore1 and bestcore2 is way below the
-                    # minimum score difference based from user defined
-                    # score thresholds
-                    if t >= mintime and bs1 - bs2 < minscorediffcheck:
-                        logging.warning('Exit search early, scorediff of {} is below minscorediff of {}'.format(
-                                bs1 - bs2, minscorediffcheck))
-                        break
-                    
-                    oldtmpmove = tmpmove
-                    
-                except (KeyError):
-                    pass
-                except Exception as e:
-                    logging.error('Unexpected exception {} in parsing engine analysis'.format(e))
+def run_server(address, analysis):
+    """ Serve the requests of analysis on address until the process is interrupted """
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = AnalysisUnixServer(addr, AnalysisHandler)
+    else:
+        server = AnalysisTCPServer(addr, AnalysisHandler)
+    server.analysis = analysis
 
-        time.sleep(0.1)
-        
-        logging.info('Search is done!!'.format(engname))
-        logging.info('game move       : {} ({})'.format(g_move, curboard.san(g_move)))
-        logging.info('complexity      : {}'.format(bestmovechanges))
-        logging.info('best move 1     : {}, best score 1: {}'.format(bm1, bs1))
-        logging.info('best move 2     : {}, best score 2: {}'.format(bm2, bs2))
-        logging.info('scorediff       : {}'.format(bs1 - bs2))
+    # A daemon is stopped with a SIGTERM, stop it like a Ctrl-C
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+    logging.info('Server is analyzing with %s engines on %s', analysis.size, address)
+    print('server: analyzing with {} engines on {}'.format(analysis.size, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+
+THRESHOLDS = ('minbs1th1', 'minbs1th2', 'minbs1th3', 'maxbs2th1', 'maxbs2th2', 'maxbs2th3')
+
+
+def classify_columns(cols, minbs1th1, minbs1th2, minbs1th3, maxbs2th1,
+                     maxbs2th2, maxbs2th3, positional=False,
+                     disable_complexity=False):
+    """ 
+    Classify all rows of cols, the arrays of load_columns, at once with the
+    score thresholds, like classify_position does for one position
+    
+    Returns an array with 2 for interesting, 1 for dull and 0 for a row that
+    is not saved.
+    """
+    bs1, bs2 = cols['bs1'], cols['bs2']
+    
+    # The skips of classify_position
+    saved = bs1 >= minbs1th3
+    if not disable_complexity:
+        saved &= ~(cols['capture'] & (cols['complexity'] <= 1))
+    saved &= bs1 - bs2 >= minbs1th3 - maxbs2th3
+    
+    if positional:
+        saved &= ~(cols['capture'] | cols['promote'])
+        # positional_pos
+        interesting = ((bs1 >= minbs1th1) & (bs1 <= minbs1th1 + 50)
+                       & (bs2 <= maxbs2th1) & (bs2 >= maxbs2th1 - 25)) \
+            | ((bs1 >= minbs1th2) & (bs1 <= minbs1th1)
+               & (bs2 <= maxbs2th2) & (bs2 >= maxbs2th2 - 25)) \
+            | ((bs1 >= minbs1th3) & (bs1 <= minbs1th2)
+               & (bs2 <= maxbs2th3) & (bs2 >= maxbs2th3 - 25))
+    else:
+        # interesting_pos, the bands are tried in the order th1, th2, th3
+        band1 = bs1 >= minbs1th1
+        band2 = ~band1 & (bs1 >= minbs1th2)
+        band3 = ~band1 & ~band2 & (bs1 >= minbs1th3)
+        interesting = (band1 & (((bs1 >= 30000) & (bs2 <= min(2000, 2*maxbs2th1)))
+                                | (bs2 <= maxbs2th1))) \
+            | (band2 & (bs2 <= maxbs2th2)) \
+            | (band3 & (bs2 <= maxbs2th3))
         
-        # Don't save positions if score is already bad
-        if bs1 < minbs1th3:
-            logging.warning('Skip this pos, score {} is below minbs1th3 of {}'.format(bs1, minbs1th3))
-            continue
+    return np.where(saved, np.where(interesting, 2, 1), 0).astype(np.int8)
+
+
+def parse_sweep(specs):
+    """ Returns the threshold settings of the grid of specs like ['minbs1th3=400,500', 'maxbs2th3=50,100'] """
+    grid = [{}]
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        if name not in THRESHOLDS:
+            raise ValueError('unknown threshold {} in --sweep, use one of {}'.format(
+                    name, ', '.join(THRESHOLDS)))
+        grid = [dict(setting, **{name: int(v)}) for setting in grid
+                for v in values.split(',')]
+    return grid
+
+
+def reclassify(argv):
+    """ The reclassify command, classify the rows of a --columns file with other thresholds """
+    parser = argparse.ArgumentParser(prog='Chess Chiller {} reclassify'.format(__version__),
+                description='Classify the positions saved by --columns again with ' +
+                'other score thresholds, the engine is not used')
+    parser.add_argument('columns', help='columnar file saved by --columns')
+    parser.add_argument('-o', '--outepd', help='output epd file of interesting positions, it is replaced (default=interesting.epd)',
+                        default='interesting.epd')
+    parser.add_argument('--dullepd', help='output epd file of dull positions, it is replaced (default=dull.epd)',
+                        default='dull.epd')
+    parser.add_argument('--positional', help='a flag to classify as positional positions',
+                        action='store_true')
+    parser.add_argument('--disable-complexity',
+                        help='a flag to disable the complexity skip of captures',
+                        action='store_true')
+    parser.add_argument('--minbs1th1', help='minimum best score 1 threshold 1 (default=2000)',
+                        default=2000, type=int)
+    parser.add_argument('--minbs1th2', help='minimum best score 1 threshold 2 (default=1000)',
+                        default=1000, type=int)
+    parser.add_argument('--minbs1th3', help='minimum best score 1 threshold 3 (default=500)',
+                        default=500, type=int)
+    parser.add_argument('--maxbs2th1', help='maximum best score 2 threshold 1 (default=300)',
+                        default=300, type=int)
+    parser.add_argument('--maxbs2th2', help='maximum best score 2 threshold 2 (default=200)',
+                        default=200, type=int)
+    parser.add_argument('--maxbs2th3', help='maximum best score 3 threshold 3 (default=100)',
+                        default=100, type=int)
+    parser.add_argument('--sweep', help='threshold and its values like minbs1th3=300,400,500, can be repeated, ' +
+                        'the yield of every combination is printed and no file is written',
+                        action='append')
+    args = parser.parse_args(argv)
+    if np is None:
+        parser.error('the numpy package is needed by reclassify, pip install numpy')
         
-        # If complexity is 1 or less and if bestmove1 is a capture, skip this position
-        if board.is_capture(bm1) and not disable_complexity and bestmovechanges <= 1:
-            logging.warning('Skip this pos, bm1 is a capture and pos complexity is below 2')
-            continue
+    # The thresholds of --positional are fixed like in a run
+    if args.positional:
+        thresholds = dict(minbs1th1=100, minbs1th2=50, minbs1th3=0,
+                          maxbs2th1=50, maxbs2th2=0, maxbs2th3=-50)
+    else:
+        thresholds = {name: getattr(args, name) for name in THRESHOLDS}
         
-        if bs1 - bs2 < minbs1th3 - maxbs2th3:
-            logging.warning('Skip this pos, min score diff of {} is below user min score diff of {}'.format(
-                    bs1 - bs2, minbs1th3 - maxbs2th3))
-            continue
+    grid = None
+    if args.sweep:
+        try:
+            grid = parse_sweep(args.sweep)
+        except ValueError as e:
+            parser.error(str(e))
         
-        # Filter on --positional to skip positions
-        if positional:
-            # (1) Skip if bestmove1 is a capture or promote
-            if board.is_capture(bm1) or len(str(bm1)) == 5:
-                logging.warning('Skip this pos, the bestmove1 is a {} move'.format('promote' if len(str(bm1))==5 else 'capture'))
-                continue
+    t0 = time.perf_counter()
+    cols = load_columns(args.columns)
+    rows = len(cols['bs1'])
+    engine_hours = float(cols['time'].sum())/3600
+    print('{} rows, {:.1f} engine-hours, loaded in {:.2f}s'.format(
+            rows, engine_hours, time.perf_counter() - t0))
+    
+    if grid is not None:
+        names = [name for name in THRESHOLDS if any(name in setting for setting in grid)]
+        print('{}  {:>11}  {:>11}  {:>11}  {:>7}  {:>9}'.format(
+                '  '.join('{:>9}'.format(name) for name in names),
+                'interesting', 'dull', 'not saved', 'yield', 'per hour'))
+        t0 = time.perf_counter()
+        for setting in grid:
+            verdicts = classify_columns(cols, positional=args.positional,
+                                        disable_complexity=args.disable_complexity,
+                                        **dict(thresholds, **setting))
+            notsaved, dull, interesting = np.bincount(verdicts, minlength=3)
+            print('{}  {:>11}  {:>11}  {:>11}  {:>6.2f}%  {:>9.1f}'.format(
+                    '  '.join('{:>9}'.format(setting[name]) for name in names),
+                    interesting, dull, notsaved, 100*interesting/max(rows, 1),
+                    interesting/engine_hours if engine_hours > 0 else 0.0))
+        print('{} settings classified in {:.2f}s'.format(len(grid), time.perf_counter() - t0))
+        return
+    
+    t0 = time.perf_counter()
+    verdicts = classify_columns(cols, positional=args.positional,
+                                disable_complexity=args.disable_complexity,
+                                **thresholds)
+    epds = cols['epd']
+    for fn, verdict in ((args.outepd, 2), (args.dullepd, 1)):
+        with open(fn, 'w') as f:
+            f.writelines(epd.decode('utf-8') + '\n' for epd in epds[verdicts == verdict])
+    notsaved, dull, interesting = np.bincount(verdicts, minlength=3)
+    print('{} interesting saved to {}, {} dull saved to {}, {} not saved, done in {:.2f}s'.format(
+            interesting, args.outepd, dull, args.dullepd, notsaved, time.perf_counter() - t0))
 
-        # Save epd if criteria is satisfied
-        is_save = False
-        if positional:
-            if positional_pos(board, bs1, bs2, minbs1th1, minbs1th2,
-                               minbs1th3, maxbs2th1, maxbs2th2, maxbs2th3):
-                is_save = True
-        else:
-            if interesting_pos(board, bs1, bs2, minbs1th1, minbs1th2,
-                               minbs1th3, maxbs2th1, maxbs2th2, maxbs2th3):
-                is_save = True
-                
-        # Create new epd
-        ae_oper = 'Analyzing engine: ' + engname
-        complexity_oper = 'Complexity: ' +  str(bestmovechanges)
-        bs2_oper = 'bestscore2: ' + str(bs2)
-        new_epd = board.epd(
-                    bm = bm1,
-                    ce = bs1,
-                    sm = g_move,
-                    acd = depth,
-                    acs = int(t),                        
-                    fmvn = board.fullmove_number,
-                    hmvc = board.halfmove_clock,
-                    pv = raw_pv,                        
-                    c0 = c0_val,
-                    c1 = complexity_oper,
-                    c2 = bs2_oper,
-                    c3 = ae_oper)
-        
-        # Save this new epd to either interesting.epd or dull.epd
-        if is_save:
-            logging.info('Save this position to {}'.format(outepdfn))
-            with open(outepdfn, 'a') as f:
-                f.write('{}\n'.format(new_epd))
-                
-            save_as_pgn(outpgnfn, curboard, game, fen, bm1, save_last_move)
-        else:
-            # Save all pos to dull.epd that were analyzed to a maxtime but
-            # failed to be saved in interesting.epd. It can be useful to
-            # improve the algorith by examing these positions visually.
-            logging.info('Saved to {}'.format(dullfn))            
-            with open(dullfn, 'a') as f:
-                f.write('{}\n'.format(new_epd))
 
-    
 def main():
+    # python chess-chiller.py reclassify ... classifies a --columns file again
+    if len(sys.argv) > 1 and sys.argv[1] == 'reclassify':
+        reclassify(sys.argv[2:])
+        return
+        
     parser = argparse.ArgumentParser(prog='Chess Chiller {}'.format(__version__),
                 description='Generates interesting positions using an engine and ' +
                 'some user defined score thresholds', epilog='%(prog)s')    
-    parser.add_argument('-i', '--inpgn', help='input pgn file',
-                        required=True)
+    parser.add_argument('-i', '--inpgn', help='input pgn file, not used with --worker',
+                        required=False)
     parser.add_argument('-o', '--outepd', help='output epd file, (default=interesting.epd)',
                         default='interesting.epd', required=False)
-    parser.add_argument('-e', '--engine', help='engine file or path',
-                        required=True)
-    parser.add_argument('-t', '--threads', help='engine threads (default=1)',
+    parser.add_argument('-e', '--engine', help='engine file or path, not used with --coordinator',
+                        required=False)
+    parser.add_argument('-t', '--threads', help='engine threads, per engine when --workers is used (default=1)',
                         default=1, type=int, required=False)
     parser.add_argument('-a', '--hash', help='engine hash in MB (default=128)',
                         default=128, type=int, required=False)
@@ -414,6 +3772,20 @@ def main():
                         default=15.0, type=float, required=False)
     parser.add_argument('--skipdraw', help='a flag to skip games with draw results',
                         action='store_true')
+    parser.add_argument('--minelo', help='skip games where a player has a lower rating or none',
+                        type=int, required=False)
+    parser.add_argument('--maxelo', help='skip games where a player has a higher rating or none',
+                        type=int, required=False)
+    parser.add_argument('--event', help='only analyze games where the Event header contains this text',
+                        required=False)
+    parser.add_argument('--mindate', help='skip games before this date, format yyyy.mm.dd',
+                        required=False)
+    parser.add_argument('--maxdate', help='skip games after this date, format yyyy.mm.dd',
+                        required=False)
+    parser.add_argument('--minply', help='skip games with fewer plies',
+                        type=int, required=False)
+    parser.add_argument('--maxply', help='skip games with more plies',
+                        type=int, required=False)
     parser.add_argument('--log', help='values can be debug, info, warning, error and critical (default=critical)',
                         default='critical', required=False)
     parser.add_argument('--pin', help='a flag when enabled will only save interesting' +
@@ -444,8 +3816,143 @@ def main():
     parser.add_argument('--save-last-move',
                         help='a flag to save the last move before the blunder move in a game.',
                         action='store_true')
+    parser.add_argument('--workers', help='number of engines that analyze games in parallel (default=1)',
+                        default=1, type=int, required=False)
+    parser.add_argument('--keep-order',
+                        help='a flag to save the positions in the same game order as the pgn file when --workers is used',
+                        action='store_true')
+    parser.add_argument('--cache', help='sqlite file to store engine searches, a position found in it is not searched again',
+                        required=False)
+    parser.add_argument('--cache-size', help='maximum number of searches kept in --cache file (default=1000000)',
+                        default=1000000, type=int, required=False)
+    parser.add_argument('--duplicates', help='values can be reuse or skip, reuse saves an already analyzed position ' +
+                        'again without searching it and skip does not save it again (default=search it again)',
+                        choices=['reuse', 'skip'], required=False)
+    parser.add_argument('--games', help='game numbers to analyze, like 1000-2000, 1000- or 1000',
+                        required=False)
+    parser.add_argument('--checkpoint', help='file to save the progress of the run (default=none, checkpoint.json with --resume)',
+                        required=False)
+    parser.add_argument('--resume', help='a flag to continue an interrupted run from its --checkpoint file',
+                        action='store_true')
+    parser.add_argument('--checkpoint-interval', help='minimum time in sec between checkpoints (default=5.0)',
+                        default=5.0, type=float, required=False)
+    parser.add_argument('--flush-interval', help='maximum time in sec the output is buffered (default=5.0)',
+                        default=5.0, type=float, required=False)
+    parser.add_argument('--flush-size', help='maximum size in bytes of the buffered output (default=65536)',
+                        default=65536, type=int, required=False)
+    parser.add_argument('--combined-output', help='save interesting and dull positions in this file instead, ' +
+                        'as json lines if it ends with .jsonl, else as epd with the type in opcode c4',
+                        required=False)
+    parser.add_argument('--screen-time', help='time in sec of a screening search before the full search',
+                        type=float, required=False)
+    parser.add_argument('--screen-depth', help='depth of a screening search before the full search',
+                        type=int, required=False)
+    parser.add_argument('--screen-nodes', help='nodes of a screening search before the full search',
+                        type=int, required=False)
+    parser.add_argument('--screen-margin', help='score margin in cp of the screening search (default=50)',
+                        default=50, type=int, required=False)
+    parser.add_argument('--screen-engine', help='engine file or path of the screening search (default=--engine)',
+                        required=False)
+    parser.add_argument('--screen-sample', help='search every nth dropped position in full to measure the drops (default=0, none)',
+                        default=0, type=int, required=False)
+    parser.add_argument('--metrics-json', help='save the run counters and stage times to this json file',
+                        required=False)
+    parser.add_argument('--metrics-prom', help='save the run counters and stage times to this file in the Prometheus text format',
+                        required=False)
+    parser.add_argument('--metrics-interval', help='interval in sec of saving the metrics files (default=10)',
+                        default=10.0, type=float, required=False)
+    parser.add_argument('--progress-interval', help='interval in sec of printing the game and position counter (default=0.5)',
+                        default=0.5, type=float, required=False)
+    parser.add_argument('--coordinator', help='serve units of games to workers on this address, host:port or unix:path',
+                        required=False)
+    parser.add_argument('--worker', help='analyze the units of games of the coordinator at this address, host:port or unix:path',
+                        required=False)
+    parser.add_argument('--serve', help='keep --workers engines running and analyze the pgn and fen jobs of http requests ' +
+                        'on this address, host:port or unix:path',
+                        required=False)
+    parser.add_argument('--unit-size', help='number of games in a unit of the coordinator (default=10)',
+                        default=10, type=int, required=False)
+    parser.add_argument('--lease', help='time in sec after which the unit of a worker that did not report is reassigned (default=60)',
+                        default=60.0, type=float, required=False)
+    parser.add_argument('--session', help='send ucinewgame to the engine only between games, the searches of a game share the hash table',
+                        action='store_true')
+    parser.add_argument('--prefetch', help='start the search of the next position when the search of a position is done',
+                        action='store_true')
+    parser.add_argument('--ply-order', help='order of the searches of the positions of a game, reverse from the end ' +
+                        'of the game or priority, first the positions where the game move is a capture, then those with ' +
+                        'more material (default=reverse)',
+                        choices=['reverse', 'priority'], default='reverse')
+    parser.add_argument('--stop-policy', help='policy that can stop a search early in addition to the score exits after --mintime, ' +
+                        'stable, depth or trend (default=default, only the score exits)',
+                        choices=STOP_POLICIES, default='default')
+    parser.add_argument('--stop-depths', help='number of depths the stable and trend policies look at (default=4)',
+                        type=int, required=False)
+    parser.add_argument('--stop-margin', help='score margin in cp of the stable (default=10) and trend (default=50) policies',
+                        type=int, required=False)
+    parser.add_argument('--stop-depth', help='depth at which the depth policy stops the search (default=20)',
+                        type=int, required=False)
+    parser.add_argument('--watchdog', help='a flag to restart an engine that hangs or dies, the search of the position is repeated',
+                        action='store_true')
+    parser.add_argument('--watchdog-margin', help='time in sec after maxtime, or the screening time, after which a search is stopped by --watchdog (default=30)',
+                        default=30.0, type=float)
+    parser.add_argument('--watchdog-retries', help='number of searches of a position after its first failed one (default=2)',
+                        default=2, type=int)
+    parser.add_argument('--reject', help='file of the positions that failed in every search of --watchdog (default=reject.epd)',
+                        default='reject.epd')
+    parser.add_argument('--known', help='polyglot .bin book or epd file of known positions that are not searched, can be repeated',
+                        action='append')
+    parser.add_argument('--known-index', help='save the hashes of the --known files to this file, later runs with the same files read it instead',
+                        required=False)
+    parser.add_argument('--pgn-eval', help='a flag to skip positions by the [%%eval] or wv= evals of the move comments of the pgn',
+                        action='store_true')
+    parser.add_argument('--pgn-eval-margin', help='skip a position if its pgn eval for the side to move is this many cp below minbs1th3 (default=100)',
+                        default=100, type=int)
+    parser.add_argument('--pgn-eval-flat', help='skip a position if the game move changes its pgn eval by less than this many cp (default=0, never)',
+                        default=0, type=int)
+    parser.add_argument('--pgn-eval-sample', help='search every nth position skipped by --pgn-eval to compare with a full run (default=0, none)',
+                        default=0, type=int)
+    parser.add_argument('--pgn-eval-depth', help='do not use the pgn evals with a d= depth below this, evals without a depth are used (default=10)',
+                        default=10, type=int)
+    parser.add_argument('--budget', help='time in sec of the run, the positions of all games are searched best first ' +
+                        'by cheap signals until it is spent',
+                        type=float, required=False)
+    parser.add_argument('--budget-sample', help='every nth search of --budget is a uniformly sampled position, ' +
+                        'to compare the yield with the pgn order (default=10, 0 none)',
+                        default=10, type=int)
+    parser.add_argument('--columns', help='save the classified positions with their scores to this file, ' +
+                        'they can be classified again with other thresholds by: chess-chiller.py reclassify FILE',
+                        required=False)
 
     args = parser.parse_args()
+    if args.inpgn is None and args.worker is None and args.serve is None:
+        parser.error('the following arguments are required: -i/--inpgn')
+    if args.serve is not None and (args.worker is not None or args.coordinator is not None
+                                   or args.duplicates is not None):
+        parser.error('--serve is not used with --worker, --coordinator or --duplicates')
+    if args.budget is not None and (args.worker is not None or args.coordinator is not None
+                                    or args.serve is not None or args.resume):
+        parser.error('--budget is not used with --worker, --coordinator, --serve or --resume')
+    if args.engine is None and args.coordinator is None:
+        parser.error('the following arguments are required: -e/--engine')
+        
+    # --inpgn can be a file, a directory or a glob of pgn files
+    if args.inpgn is not None:
+        pgnfns = pgn_files(args.inpgn)
+        if not pgnfns:
+            parser.error('no pgn file found in {}'.format(args.inpgn))
+        if zstandard is None and any(fn.lower().endswith('.zst') for fn in pgnfns):
+            parser.error('the zstandard package is needed to read .zst files, pip install zstandard')
+        single_pgn = pgnfns == [args.inpgn] and not is_compressed(args.inpgn)
+        if args.coordinator is not None and not single_pgn:
+            parser.error('--coordinator needs one uncompressed pgn file')
+    if args.known is None and args.known_index is not None \
+            and not os.path.exists(args.known_index):
+        parser.error('--known-index {} does not exist, build it with --known'.format(args.known_index))
+    if args.columns is not None:
+        if np is None:
+            parser.error('the numpy package is needed by --columns, pip install numpy')
+        if args.worker is not None or args.coordinator is not None or args.serve is not None:
+            parser.error('--columns is not used with --worker, --coordinator or --serve')
 
     pgnfn = args.inpgn
     outepdfn = args.outepd
@@ -465,15 +3972,18 @@ def main():
     # Define logging levels
     if args.log == 'debug':
         # logging.DEBUG includes engine logs
-        initialize_logger(logging.DEBUG)
+        listener = initialize_logger(logging.DEBUG)
     elif args.log == 'info':
-        initialize_logger(logging.INFO)
+        listener = initialize_logger(logging.INFO)
     elif args.log == 'warning':
-        initialize_logger(logging.WARNING)
+        listener = initialize_logger(logging.WARNING)
     elif args.log == 'error':
-        initialize_logger(logging.ERROR)
+        listener = initialize_logger(logging.ERROR)
     else:
-        initialize_logger(logging.CRITICAL)
+        listener = initialize_logger(logging.CRITICAL)
+        
+    # Write the logs still in the queue at exit, also after an error
+    atexit.register(listener.stop)
    
     start_move = args.analysis_start_move
     dullfn = 'dull.epd'  # Save uninteresting positions in this file
@@ -505,88 +4015,318 @@ def main():
     scoredifflist.append(minbs1th3 - maxbs2th3)
     minscorediffcheck = min(scoredifflist)/2
     
-    logging.info('pgn file: {}'.format(pgnfn))    
+    logging.info('pgn file: %s', pgnfn)
     logging.info('Conditions:')
-    logging.info('mininum time               : {}s'.format(mintime))
-    logging.info('maximum time               : {}s'.format(maxtime))
-    logging.info('mininum score diff check   : {}'.format(minscorediffcheck))
-    logging.info('mininum best score 1 th 1  : {}'.format(minbs1th1))
-    logging.info('mininum best score 1 th 2  : {}'.format(minbs1th2))
-    logging.info('mininum best score 1 th 3  : {}'.format(minbs1th3))
-    logging.info('maximum best score 2 th 1  : {}'.format(maxbs2th1))
-    logging.info('maximum best score 2 th 2  : {}'.format(maxbs2th2))
-    logging.info('maximum best score 2 th 3  : {}'.format(maxbs2th3))
-    logging.info('stm is not in check        : {}'.format('Yes'))
-    logging.info('stop analysis move number  : {}'.format(start_move))
+    logging.info('mininum time               : %ss', mintime)
+    logging.info('maximum time               : %ss', maxtime)
+    logging.info('mininum score diff check   : %s', minscorediffcheck)
+    logging.info('mininum best score 1 th 1  : %s', minbs1th1)
+    logging.info('mininum best score 1 th 2  : %s', minbs1th2)
+    logging.info('mininum best score 1 th 3  : %s', minbs1th3)
+    logging.info('maximum best score 2 th 1  : %s', maxbs2th1)
+    logging.info('maximum best score 2 th 2  : %s', maxbs2th2)
+    logging.info('maximum best score 2 th 3  : %s', maxbs2th3)
+    logging.info('stm is not in check        : %s', 'Yes')
+    logging.info('stop analysis move number  : %s', start_move)
     logging.info(f'disable complexity         : {disable_complexity}')
             
-    # Define analyzing engine
-    engine = chess.engine.SimpleEngine.popen_uci(enginefn)
-    engname = engine.id['name']
+    analysis_options = dict(mintime=mintime,
+                            maxtime=maxtime,
+                            minscorediffcheck=minscorediffcheck,
+                            minbs1th1=minbs1th1,
+                            minbs1th2=minbs1th2,
+                            minbs1th3=minbs1th3,
+                            maxbs2th1=maxbs2th1,
+                            maxbs2th2=maxbs2th2,
+                            maxbs2th3=maxbs2th3,
+                            weightsfile=weightsfile,
+                            skipdraw=skipdraw,
+                            pin=pin,
+                            positional=positional,
+                            minpiecevalue=minpiecevalue,
+                            maxpiecevalue=maxpiecevalue,
+                            disable_complexity=disable_complexity,
+                            save_last_move=args.save_last_move,
+                            progress_interval=args.progress_interval,
+                            session=args.session,
+                            prefetch=args.prefetch,
+                            ply_order=args.ply_order)
     
-    # Set Lc0 SmartPruningFactor to 0 to avoid analysis time pruning
-    if 'lc0' in engname.lower():
+    cache = None
+    if args.cache is not None:
+        logging.info('analysis cache             : %s', args.cache)
+        cache = AnalysisCache(args.cache, maxsize=args.cache_size)
+        analysis_options['cache'] = cache
+        
+    tpindex = None
+    if args.duplicates is not None:
+        logging.info('duplicate positions        : %s', args.duplicates)
+        tpindex = TranspositionIndex(skip=args.duplicates == 'skip')
+        analysis_options['tpindex'] = tpindex
+        
+    if args.stop_policy != 'default':
+        logging.info('stop policy                : %s', args.stop_policy)
+        analysis_options['stop_policy'] = stop_policy(args.stop_policy, minbs1th3, maxbs2th3,
+                                                      depths=args.stop_depths,
+                                                      margin=args.stop_margin,
+                                                      depth=args.stop_depth)
+        
+    known = None
+    if args.known is not None or args.known_index is not None:
+        t0 = time.perf_counter()
+        known = KnownPositions(args.known or [], indexfn=args.known_index)
+        logging.info('known positions            : %s in %.1fs',
+                len(known), time.perf_counter() - t0)
+        analysis_options['known'] = known
+        
+    pgn_eval = None
+    if args.pgn_eval:
+        logging.info('pgn eval margin            : %s', args.pgn_eval_margin)
+        logging.info('pgn eval flat              : %s', args.pgn_eval_flat)
+        logging.info('pgn eval depth             : %s', args.pgn_eval_depth)
+        pgn_eval = PgnEvalFilter(minbs1th3, margin=args.pgn_eval_margin,
+                                 flat=args.pgn_eval_flat, sample=args.pgn_eval_sample,
+                                 depth=args.pgn_eval_depth)
+        analysis_options['pgn_eval'] = pgn_eval
+        
+    # Screen positions with a short search before the full search
+    cascade = None
+    if args.screen_time is not None or args.screen_depth is not None \
+            or args.screen_nodes is not None:
+        screen_limit = chess.engine.Limit(time=args.screen_time,
+                                          depth=args.screen_depth,
+                                          nodes=args.screen_nodes)
+        logging.info('screening limit            : %s', screen_limit)
+        logging.info('screening margin           : %s', args.screen_margin)
+        cascade = ScreeningCascade(screen_limit, args.screen_margin,
+                                   minbs1th1, minbs1th2, minbs1th3,
+                                   maxbs2th1, maxbs2th2, maxbs2th3,
+                                   positional=positional,
+                                   sample=args.screen_sample)
+        analysis_options['cascade'] = cascade
+        
+    # The next search cannot start before the cache, the duplicates index
+    # or the screening search has decided on the next position
+    if args.prefetch and (cache is not None or tpindex is not None or cascade is not None):
+        logging.warning('--prefetch is not used with --cache, --duplicates or the screening search')
+        print('warning: --prefetch is not used with --cache, --duplicates or the screening search')
+        
+    # Counters and stage times of the run, saved periodically if asked
+    metrics = Metrics(jsonfn=args.metrics_json, promfn=args.metrics_prom,
+                      interval=args.metrics_interval)
+    analysis_options['metrics'] = metrics
+    
+    # Kill and restart engines that do not finish a search in time
+    watchdog = None
+    if args.watchdog:
+        logging.info('watchdog margin            : %ss', args.watchdog_margin)
+        watchdog = dict(margin=args.watchdog_margin, retries=args.watchdog_retries,
+                        rejectfn=args.reject, maxtime=maxtime, metrics=metrics)
+        
+    # Analyze the jobs of requests with engines that are started once
+    if args.serve is not None:
+        filter_options = dict(skipdraw=skipdraw, minelo=args.minelo,
+                              maxelo=args.maxelo, event=args.event,
+                              mindate=args.mindate, maxdate=args.maxdate,
+                              minply=args.minply, maxply=args.maxply)
+        engines = [start_engine(enginefn, hash_val, thread_val, weightsfile,
+                                watchdog=watchdog)
+                   for _ in range(args.workers)]
+        analysis = AnalysisServer(engines, enginefn, hash_val, thread_val,
+                                  start_move,
+                                  dict(analysis_options, progress_interval=float('inf')),
+                                  filter_options, metrics)
         try:
-            engine.configure({"SmartPruningFactor": 0})
-        except:
-            pass
+            run_server(args.serve, analysis)
+        finally:
+            for engine, _ in engines:
+                stop_engine(engine)
+            metrics.close()
+            if cache is not None:
+                cache.close()
+        logging.info(metrics.stats())
+        print(metrics.stats())
+        return
+        
+    # Analyze the games sent by a coordinator, with the options of the
+    # coordinator and the local engine, cache and duplicates index
+    if args.worker is not None:
+        local_options = {k: v for k, v in analysis_options.items()
+                         if k in ('cache', 'tpindex', 'metrics', 'known', 'stop_policy',
+                                  'pgn_eval')}
+        logging.info('coordinator                : %s', args.worker)
+        threads = [threading.Thread(target=run_worker, name='worker{}'.format(i),
+                                    args=(args.worker, enginefn, hash_val, thread_val,
+                                          weightsfile, local_options,
+                                          dict(watchdog, maxtime=None) if watchdog else None,
+                                          args.screen_engine))
+                   for i in range(args.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.close()
+        if cache is not None:
+            cache.close()
+        logging.info(metrics.stats())
+        print(metrics.stats())
+        return
+    
+    # Games that do not pass the header filters are not parsed
+    filter_options = dict(skipdraw=skipdraw, minelo=args.minelo,
+                          maxelo=args.maxelo, event=args.event,
+                          mindate=args.mindate, maxdate=args.maxdate,
+                          minply=args.minply, maxply=args.maxply)
+    game_filter = GameFilter(**filter_options)
+    
+    writer = OutputWriter({outepdfn: 'interesting', dullfn: 'dull', outpgnfn: 'pgn'},
+                          flush_interval=args.flush_interval,
+                          flush_size=args.flush_size,
+                          combinedfn=args.combined_output)
+    
+    columns = None
+    if args.columns is not None:
+        logging.info('columns file               : %s', args.columns)
+        columns = ColumnWriter(args.columns)
+        analysis_options['columns'] = columns
+        
+    # Continue from the checkpoint of an interrupted run, the progress is
+    # saved only with --checkpoint or --resume
+    checkpointfn = args.checkpoint
+    if checkpointfn is None and args.resume:
+        checkpointfn = 'checkpoint.json'
+    checkpoint = Checkpoint(checkpointfn, pgnfn, writer,
+                            interval=args.checkpoint_interval, columns=columns)
+    if args.resume:
+        if checkpoint.load():
+            logging.info('resume from game           : %s', checkpoint.next_game)
+        else:
+            logging.warning('No checkpoint in %s, start from the first game', checkpointfn)
+    
+    first, last = parse_game_range(args.games) if args.games else (1, None)
+    first = max(first, checkpoint.next_game)
+    
+    # Serve units of games to workers, the results are saved here
+    if args.coordinator is not None:
+        units = [unit for unit in game_units(pgnfn, pgn_index(pgnfn), args.unit_size,
+                                             first, last)
+                 if not all(checkpoint.is_done(g) for g in range(unit[0], unit[1] + 1))]
+        job = {'options': {k: v for k, v in analysis_options.items()
+                           if k not in ('weightsfile', 'cache', 'tpindex',
+                                        'cascade', 'metrics', 'known', 'stop_policy',
+                                        'pgn_eval')},
+               'filter': filter_options,
+               'start_move': start_move,
+               'screen': None}
+        
+        # The workers make their own screening cascade from these options
+        if cascade is not None:
+            job['screen'] = {'time': args.screen_time, 'depth': args.screen_depth,
+                             'nodes': args.screen_nodes, 'margin': args.screen_margin,
+                             'sample': args.screen_sample}
+        coordinator = Coordinator(pgnfn, units, writer,
+                                  {'interesting': outepdfn, 'dull': dullfn, 'pgn': outpgnfn},
+                                  job, lease=args.lease, checkpoint=checkpoint)
+        run_coordinator(args.coordinator, coordinator)
+        checkpoint.close()
+        writer.close()
+        metrics.close()
+        logging.info(coordinator.stats())
+        print(coordinator.stats())
+        return
+    
+    # A single pgn file is read with the byte offsets of its games, the
+    # files of a directory or glob and compressed files one after the other
+    if single_pgn:
+        offsets = pgn_index(pgnfn) if first > 1 else None
+        pgn = open(pgnfn, 'r')
+        reader = GameReader(pgn, game_filter, first=first, last=last,
+                            offsets=offsets, skip=checkpoint.finished)
     else:
-        try:
-            engine.configure({"Hash": hash_val})
-        except:
-            pass 
+        logging.info('pgn files                  : %s', len(pgnfns))
+        pgn = None
+        reader = MultiGameReader(pgnfns, game_filter, first=first, last=last,
+                                 skip=checkpoint.finished)
+        analysis_options['source_of'] = reader.source
         
+    scheduler = None
     try:
-        engine.configure({"Threads": thread_val})
-    except:
-        pass
+        # Search the positions of all games best first until the budget is spent
+        if args.budget is not None:
+            logging.info('budget                     : %ss', args.budget)
+            scheduler = BudgetScheduler(args.budget, minbs1th3, sample=args.budget_sample)
+            analyze_budget(reader, args.workers, enginefn, hash_val, thread_val,
+                           start_move, outepdfn, dullfn, outpgnfn,
+                           analysis_options, writer, scheduler,
+                           screen_enginefn=args.screen_engine, watchdog=watchdog)
+            
+        # Run several engines in parallel, one game per engine at a time
+        elif args.workers > 1:
+            logging.info('workers                    : %s', args.workers)
+            logging.info('keep order                 : %s', args.keep_order)
+            analyze_games_parallel(reader, args.workers, enginefn, hash_val,
+                                   thread_val, start_move, outepdfn, dullfn,
+                                   outpgnfn, analysis_options, writer,
+                                   keep_order=args.keep_order,
+                                   checkpoint=checkpoint,
+                                   screen_enginefn=args.screen_engine,
+                                   watchdog=watchdog)
+        else:
+            analyze_games(reader, enginefn, hash_val, thread_val, weightsfile,
+                          start_move, outepdfn, dullfn, outpgnfn,
+                          analysis_options, writer, checkpoint=checkpoint,
+                          screen_enginefn=args.screen_engine,
+                          watchdog=watchdog)
+    finally:
+        if pgn is not None:
+            pgn.close()
+            
+    checkpoint.close()
+    writer.close()
+    metrics.close()
+            
+    logging.info(reader.stats())
+    print(reader.stats())
     
-    # For NN engine that uses uci option WeightsFile similar to Lc0
-    if weightsfile is not None:
-        try:
-            engine.configure({"WeightsFile": weightsfile})
-        except:
-            pass
+    if scheduler is not None:
+        logging.info(scheduler.stats())
+        print(scheduler.stats())
         
-    # Read pgn file and analyze positions in the game    
-    gcnt = 0    
-    with open(pgnfn, 'r') as pgn:
-        game = chess.pgn.read_game(pgn)        
-        while game:
-            gcnt += 1 
-            analyze_game(game,
-                     engine,
-                     enginefn,
-                     hash_val,
-                     thread_val,
-                     start_move,
-                     outepdfn,
-                     gcnt,
-                     engname,
-                     dullfn,
-                     outpgnfn,
-                     mintime=mintime,
-                     maxtime=maxtime,
-                     minscorediffcheck=minscorediffcheck,
-                     minbs1th1=minbs1th1,
-                     minbs1th2=minbs1th2,    
-                     minbs1th3=minbs1th3,
-                     maxbs2th1=maxbs2th1,
-                     maxbs2th2=maxbs2th2,    
-                     maxbs2th3=maxbs2th3,
-                     weightsfile=weightsfile,
-                     skipdraw=skipdraw,
-                     pin=pin,
-                     positional=positional,
-                     minpiecevalue=minpiecevalue,
-                     maxpiecevalue=maxpiecevalue,
-                     disable_complexity=args.disable_complexity,
-                     save_last_move=args.save_last_move)
-            
-            # Analyze another game
-            game = chess.pgn.read_game(pgn)
+    if columns is not None:
+        columns.close()
+        logging.info(columns.stats())
+        print(columns.stats())
+        
+    if cache is not None:
+        cache.close()
+        logging.info(cache.stats())
+        print(cache.stats())
+        
+    if tpindex is not None:
+        logging.info(tpindex.stats())
+        print(tpindex.stats())
+        
+    if cascade is not None:
+        logging.info(cascade.stats())
+        print(cascade.stats())
+        
+    # The engine time of a skipped position is estimated with the average
+    # time of the searches of this run
+    counters = metrics.snapshot()['counters']
+    searches = counters.get('searches', {})
+    seconds = counters.get('engine_seconds', 0.0) \
+        / max(1, searches.get('engine', 0) + searches.get('screen', 0))
+    
+    if known is not None:
+        logging.info(known.stats(seconds))
+        print(known.stats(seconds))
+        
+    if pgn_eval is not None:
+        logging.info(pgn_eval.stats(seconds))
+        print(pgn_eval.stats(seconds))
         
-    engine.quit()
+    logging.info(metrics.stats())
+    print(metrics.stats())
 
 
 if __name__ == '__main__':